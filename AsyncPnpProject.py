@@ -0,0 +1,713 @@
+#!/usr/bin/python
+""" asyncio versions of the PnpProject classes.  Requires aiohttp.
+
+    The async classes have the same methods and semantics as PnpFileHandler, PnpProject and PnpDevice,
+    except that every method that talks to APIC-EM is a coroutine.  sync, watch, import_manifest and
+    sync_directory run their work on threads with blocking calls and are only on the sync classes.
+    All the objects created from one AsyncPnpClient share its connection pool, and the number of
+    requests in flight is bounded by the client's semaphore, so thousands of operations can be
+    gathered at once.
+"""
+import asyncio
+import collections
+import json
+import os
+import sys
+import time
+import traceback
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+
+from PnpProject import (GET, POST, PUT, DELETE, DEFAULT_POOL_SIZE, DEFAULT_CHUNK_SIZE, DEFAULT_PAGE_SIZE, TASK_POLL_INTERVAL,
+                        TASK_POLL_MAX_INTERVAL, TASK_POLL_BACKOFF, TASK_DEADLINE, TICKET_CACHE_PATH, PnpClient, PnpDevice,
+                        PnpTicketProvider, MultipartFileStream, parse_task_progress, get_task_rule_ids, PnpListingError,
+                        file_checksum, _device_key, _PnpFileHandlerBase, _PnpProjectBase)
+import PnpProject as _sync
+
+# What PnpConcurrencyController.release reads from a response
+_ControllerResponse = collections.namedtuple('_ControllerResponse', 'status_code headers')
+
+
+class AsyncPnpClient(PnpClient):
+    """ AsyncPnpClient holds one aiohttp connection pool to a single APIC-EM server.
+
+        pool_size is the number of pooled connections and concurrency (pool_size by default) is the
+        number of requests allowed in flight at once.  With a PnpConcurrencyController (controller=),
+        the controller decides how many of those are sent, like with PnpClient.  Like PnpClient it can be
+        used as the old credentials dict.  Close it with 'await client.close()' or use it as an async
+        context manager.
+    """
+    def __init__(self, server, ticket=None, pool_size=DEFAULT_POOL_SIZE, concurrency=None, verify=False, timeout=None,
+                 ticket_provider=None, scheme='https', controller=None):
+        self.server = server
+        self.ticket = ticket
+        self.ticket_provider = ticket_provider
+        self.verify = verify
+        self.timeout = timeout
+        self.controller = controller
+        if controller is not None:
+            # Enough pooled connections for every call the controller may let through
+            pool_size = max(pool_size, controller.max_concurrency)
+        self.pool_size = pool_size
+        self.concurrency = concurrency or pool_size
+        self.scheme = scheme
+        self.base_url = scheme + '://' + server
+        self._session = None
+        self._semaphore = None
+        self._controller_executor = None
+
+    @property
+    def session(self):
+        # The session and semaphore are created lazily so they belong to the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ssl=None if self.verify else False)
+            timeout = aiohttp.ClientTimeout(total=self.timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    async def request(self, command, url, **kwargs):
+        """ Returns (status code, response json or None)
+        """
+        session = self.session
+        async with self._semaphore:
+            if self.controller is None:
+                status, value, headers = await self._send(session, command, url, kwargs)
+                return status, value
+            start = await self._acquire()
+            response = None
+            try:
+                status, value, headers = await self._send(session, command, url, kwargs)
+                response = _ControllerResponse(status, headers)
+                return status, value
+            finally:
+                self.controller.release(start, response)
+
+    async def _send(self, session, command, url, kwargs):
+        async with session.request(command.upper(), self.base_url + url, **kwargs) as r:
+            value = None
+            if r.status < 400:
+                value = await r.json(content_type=None)
+            return r.status, value, r.headers
+
+    async def _acquire(self):
+        # The controller blocks until it has a free slot, so it waits on threads of its own instead of
+        # the event loop (at most concurrency of them, one per request allowed by the semaphore)
+        if self._controller_executor is None:
+            self._controller_executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        acquire = asyncio.get_running_loop().run_in_executor(self._controller_executor, self.controller.acquire)
+        try:
+            return await asyncio.shield(acquire)
+        except asyncio.CancelledError:
+            # The slot is taken once acquire returns, it is given back
+            acquire.add_done_callback(lambda future: self.controller.release(future.result(), None))
+            raise
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+        if self._controller_executor is not None:
+            self._controller_executor.shutdown(wait=False)
+            self._controller_executor = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def async_pnp_login(username, password, server, ticket_cache=TICKET_CACHE_PATH, **client_options):
+    """ Async version of pnp_login, returns an AsyncPnpClient holding the service ticket
+        client_options are passed to AsyncPnpClient (pool_size, concurrency, verify, timeout, scheme,
+        controller).
+        Tickets are cached and refreshed like with pnp_login, logins run in the default executor.
+    """
+    client = AsyncPnpClient(server, **client_options)
+    login_client = PnpClient(server, verify=client.verify, timeout=client.timeout, scheme=client.scheme)
+    client.ticket_provider = PnpTicketProvider(username, password, server, ticket_cache, login_client)
+    loop = asyncio.get_running_loop()
+    client.ticket = await loop.run_in_executor(None, client.ticket_provider.get_ticket)
+    if client.ticket is None:
+        await client.close()
+        return None
+    return client
+
+
+async def async_make_rest_call(client, command, url, aData=None, files=None, stream=None):
+    """ Async version of make_rest_call.  files is a dictionary of {'file': (file name, file object)}
+        and stream a MultipartFileStream.  Hooks get 0 for the bytes received, aiohttp decodes the
+        response without exposing its size
+    """
+    start = time.time() if _sync._hooks else None
+    status = None
+    retries = 0
+    try:
+        if command not in (GET, POST, PUT, DELETE):
+            print('Unknown command!')
+            return None
+
+        def make_payload():
+            payload = None
+            if(aData is not None):
+                payload = json.dumps(aData)
+
+            if files is not None:
+                header = {'X-Auth-Token': client.ticket}
+                payload = aiohttp.FormData()
+                for field, (file_name, file_object) in files.items():
+                    payload.add_field(field, file_object, filename=file_name)
+            elif stream is not None:
+                header = {'X-Auth-Token': client.ticket, 'content-type': stream.content_type,
+                          'content-length': str(len(stream))}
+                payload = _read_stream(stream)
+            else:
+                header = {'X-Auth-Token': client.ticket, 'content-type': 'application/json'}
+            return payload, header
+
+        payload, header = make_payload()
+        status, response_json = await client.request(command, url, data=payload, headers=header)
+        if status == 401 and client.ticket_provider is not None:
+            # The ticket expired, send the request again with a new one
+            loop = asyncio.get_running_loop()
+            if await loop.run_in_executor(None, client.refresh_ticket, header['X-Auth-Token']) is not None:
+                if stream is not None:
+                    stream.rewind()
+                if files is not None:
+                    _sync._rewind_files(files)
+                payload, header = make_payload()
+                retries = 1
+                status, response_json = await client.request(command, url, data=payload, headers=header)
+        if client.ticket_provider is not None and status != 401:
+            client.ticket_provider.touch()
+        if start is not None:
+            bytes_out = len(stream) if stream is not None else len(payload) if isinstance(payload, str) else 0
+            _sync._call_hooks('on_request', command, _sync.endpoint_template(url), status, time.time() - start,
+                              bytes_out, 0, retries, status >= 400)
+        if _sync.DEBUG:
+            print(client.base_url + url, payload, header)
+            print('Returned status code: %d' % status)
+
+        if(not response_json):
+            print('No data returned! ' + url)
+            return None
+        return response_json
+    except:
+        if start is not None and status is None:
+            _sync._call_hooks('on_request', command, _sync.endpoint_template(url), None, time.time() - start, 0, 0,
+                              retries, True)
+        err = sys.exc_info()[0]
+        msg_det = sys.exc_info()[1]
+        print('Error: %s  Details: %s StackTrace: %s' %
+              (err, msg_det, traceback.format_exc()))
+
+
+async def _read_stream(stream):
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(None, stream.read, stream.chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def async_poll_task(client, task_id):
+    response = await async_make_rest_call(client, GET, '/api/v1/task/' + task_id)
+    if(not response):
+        return {'isError': True, 'failureReason': 'Unable to retrieve task_id'}
+    if 'endTime' not in response['response']:
+        return None
+    return response['response']
+
+
+async def async_get_task_id(client, task_id, deadline=TASK_DEADLINE):
+    """ Async version of get_task_id, polls the task with the same growing interval
+    """
+    interval = TASK_POLL_INTERVAL
+    start = time.time()
+    end_time = start + deadline
+    polls = 0
+    while True:
+        task_status = await async_poll_task(client, task_id)
+        polls += 1
+        if task_status is None and time.time() + interval > end_time:
+            task_status = {'isError': True, 'failureReason': 'Task did not complete in %d seconds' % deadline}
+        if task_status is not None:
+            if client.controller is not None:
+                client.controller.record_task(time.time() - start)
+            if _sync._hooks:
+                _sync._call_hooks('on_task', task_id, time.time() - start, polls, task_status)
+            return task_status
+        await asyncio.sleep(interval)
+        interval = min(interval * TASK_POLL_BACKOFF, TASK_POLL_MAX_INTERVAL)
+
+
+async def async_iter_pages(client, url, page_size=DEFAULT_PAGE_SIZE):
+    """ Async version of iter_pages, an async generator of the records of a paginated listing.  Raises
+        PnpListingError if a page can't be read
+    """
+    separator = '&' if '?' in url else '?'
+    offset = 1
+    while True:
+        response = await async_make_rest_call(client, GET, url + separator + 'offset=%d&limit=%d' % (offset, page_size))
+        if not response:
+            raise PnpListingError(url, offset, 'no data returned')
+        page = response['response']
+        if 'errorCode' in page:
+            raise PnpListingError(url, offset, page['message'] + ' (' + page['detail'] + ')')
+        for record in page:
+            yield record
+        if len(page) < page_size:
+            return
+        offset += len(page)
+
+
+class AsyncPnpFileHandler(_PnpFileHandlerBase):
+    async def refresh_file_list(self, type='config'):
+        if type != 'config' and type != 'image':
+            return None
+        self._set_file_list(type, await async_make_rest_call(self.client, GET, '/api/v1/file/namespace/' + type))
+
+    async def get_file_id_by_name(self, file_name, type='config'):
+        file = await self._lookup_file('name', file_name, type)
+        if file is not None:
+            return file['id']
+        return None
+
+    async def get_file_name_by_id(self, id, type='config'):
+        file = await self._lookup_file('id', id, type)
+        if file is not None:
+            return file['name']
+        return None
+
+    async def get_file_id_by_checksum(self, checksum, type='config', algorithm='md5'):
+        file = await self._lookup_file(algorithm + 'Checksum', checksum, type)
+        if file is not None:
+            return file['id']
+        return None
+
+    async def _lookup_file(self, key, value, type):
+        if type != 'config' and type != 'image':
+            return None
+        file, refresh = self._find_file(key, value, type)
+        if refresh and self._index[type] is None and self._load_cached_file_list(type):
+            file, refresh = self._find_file(key, value, type)
+        if refresh:
+            await self.refresh_file_list(type)
+            file, refresh = self._find_file(key, value, type)
+        if file is None:
+            self._add_miss(key, value, type)
+        return file
+
+    async def upload_file(self, path, type='config', callback=None, dedupe=True):
+        if type != 'config' and type != 'image':
+            return None
+        if not os.path.isfile(path):
+            return None
+
+        file_name = os.path.basename(path)
+        if not (file_name[-3:] == 'txt' or type == 'image'):
+            file_name += '.txt'
+
+        if dedupe:
+            checksum = await asyncio.get_running_loop().run_in_executor(None, file_checksum, path)
+            file_id = await self.get_file_id_by_checksum(checksum, type)
+            if file_id is not None:
+                return file_id
+
+        stream = MultipartFileStream(path, file_name, callback=callback)
+        try:
+            response = await async_make_rest_call(self.client, POST, '/api/v1/file/'+type, stream=stream)
+        finally:
+            stream.close()
+        if not response or 'id' not in response['response']:
+            return None
+
+        uploaded = dict(response['response'])
+        uploaded.setdefault('name', file_name)
+        uploaded.setdefault('md5Checksum', stream.md5.hexdigest())
+        if uploaded['md5Checksum'] != stream.md5.hexdigest():
+            print('Warning: Checksum of uploaded file does not match: ' + path)
+        self._add_file(type, uploaded)
+        if self.manifest is not None:
+            self.manifest.add(type, uploaded['name'], uploaded['id'], stream.md5.hexdigest())
+        return uploaded['id']
+
+    async def delete_file(self, file_id, type='config', check=True):
+        if type != 'config' and type != 'image':
+            return None
+        if not check or await self.get_file_name_by_id(file_id, type):
+            response = await async_make_rest_call(self.client, DELETE, '/api/v1/pnp-file/'+type+'/'+file_id)
+            if not response or 'taskId' not in response['response']:
+                return None
+            task_status = await async_get_task_id(self.client, response['response']['taskId'])
+            if (task_status['isError']):
+                return None
+            else:
+                self._remove_file(type, file_id)
+                if self.manifest is not None:
+                    self.manifest.remove_id(type, file_id)
+                return True
+
+    async def delete_files(self, file_ids, type='config', deadline=TASK_DEADLINE):
+        """ Async version of PnpFileHandler.delete_files, the files are deleted concurrently
+        """
+        if type != 'config' and type != 'image':
+            return None
+
+        async def delete(file_id):
+            if not await self.get_file_name_by_id(file_id, type):
+                return None
+            response = await async_make_rest_call(self.client, DELETE, '/api/v1/pnp-file/'+type+'/'+file_id)
+            if not response or 'taskId' not in response['response']:
+                return None
+            task_status = await async_get_task_id(self.client, response['response']['taskId'], deadline)
+            if task_status['isError']:
+                return None
+            self._remove_file(type, file_id)
+            if self.manifest is not None:
+                self.manifest.remove_id(type, file_id)
+            return True
+
+        file_ids = list(file_ids)
+        return dict(zip(file_ids, await asyncio.gather(*[delete(file_id) for file_id in file_ids])))
+
+class AsyncPnpProject(_PnpProjectBase):
+    async def create_project(self, project_parameters=None):
+        if project_parameters is None:
+            project_parameters = self.create_project_parameters()
+
+        response = await async_make_rest_call(self.client, POST, '/api/v1/pnp-project', [project_parameters])
+        if not response or 'taskId' not in response['response']:
+            self.id = None
+            self.error = True
+            self.error_reason = 'Unable to create project'
+            return None
+        task_status = await async_get_task_id(self.client, response['response']['taskId'])
+
+        if (task_status['isError']):
+            self.id = None
+            self.error = True
+            self.error_reason = task_status['failureReason']
+            return None
+        progress = parse_task_progress(task_status)
+        if isinstance(progress, dict) and 'siteId' in progress:
+            self.id = progress['siteId']
+            await self.get_project_by_id(self.id, False)
+            return self.id
+
+    async def update_project(self, project_parameters=None):
+        if project_parameters is None:
+            project_parameters = self.create_project_parameters()
+
+        response = await async_make_rest_call(self.client, PUT, '/api/v1/pnp-project', [project_parameters])
+        if not response or 'taskId' not in response['response']:
+            self.error = True
+            self.error_reason = 'Unable to update project'
+            return None
+        task_status = await async_get_task_id(self.client, response['response']['taskId'])
+
+        if (task_status['isError']):
+            self.id = None
+            self.error = True
+            self.error_reason = task_status['failureReason']
+            return None
+        await self.get_project_by_id(self.id, False)
+        return self.id
+
+    async def add_device(self, device):
+        await device.create_device(self)
+        if device.error:
+            print('Error Adding Device to Project: ' + device.error_reason + '(Device Name: ' + str(device.hostName) + ')')
+            return None
+        self.device_list.add(device)
+        await self.get_project_by_id(self.id, False)
+        return device
+
+    async def add_device_with_parameters(self, device_parameters):
+        device = AsyncPnpDevice()
+        await device.create_device(self, device_parameters)
+        if device.error:
+            print('Error Adding Device to Project: ' + device.error_reason + '(Device Name: ' + str(device_parameters.get('hostName')) + ')')
+            return None
+        self.device_list.add(device)
+        await self.get_project_by_id(self.id, False)
+        return device
+
+    async def add_devices(self, devices, chunk_size=DEFAULT_CHUNK_SIZE, deadline=TASK_DEADLINE):
+        """ Async version of PnpProject.add_devices, the chunks are sent and waited on concurrently
+        """
+        pending = []
+        for item in devices:
+            if isinstance(item, PnpDevice):
+                pending.append((item, item.create_device_parameters()))
+            else:
+                device = AsyncPnpDevice()
+                device.populate_device(item)
+                pending.append((device, item))
+
+        chunks = [pending[start:start + chunk_size] for start in range(0, len(pending), chunk_size)]
+        results = await asyncio.gather(*[self._add_chunk(chunk, deadline) for chunk in chunks])
+
+        unresolved = [item for chunk_unresolved in results for item in chunk_unresolved]
+        if unresolved:
+            existing = {}
+            try:
+                async for deviceDetail in self.iter_device_details():
+                    existing[_device_key(deviceDetail)] = deviceDetail
+            except PnpListingError as e:
+                print('Error: ' + str(e))
+            for device, device_parameters in unresolved:
+                key = _device_key(device_parameters)
+                if key is not None and key in existing:
+                    self._device_added(device, existing[key], existing[key]['id'])
+                else:
+                    self._device_failed(device, device_parameters, 'Unable to locate device after adding it to Project')
+
+        await self.get_project_by_id(self.id, False)
+        return [device for device, device_parameters in pending]
+
+    async def _add_chunk(self, chunk, deadline):
+        response = await async_make_rest_call(self.client, POST, '/api/v1/pnp-project/' + self.id + '/device',
+                                              [device_parameters for device, device_parameters in chunk])
+        if not response or 'taskId' not in response['response']:
+            task_status = {'isError': True, 'failureReason': 'Unable to create devices'}
+        else:
+            task_status = await async_get_task_id(self.client, response['response']['taskId'], deadline)
+
+        if task_status['isError'] and len(chunk) > 1:
+            # Sent again one device at a time, so only the devices that caused the error fail
+            results = await asyncio.gather(*[self._add_chunk([item], deadline) for item in chunk])
+            return [item for chunk_unresolved in results for item in chunk_unresolved]
+        if task_status['isError']:
+            device, device_parameters = chunk[0]
+            self._device_failed(device, device_parameters, task_status['failureReason'])
+            return []
+
+        rule_ids = get_task_rule_ids(task_status)
+        if len(rule_ids) != len(chunk):
+            return chunk
+        for (device, device_parameters), rule_id in zip(chunk, rule_ids):
+            self._device_added(device, device_parameters, rule_id)
+        return []
+
+    async def update_devices(self, devices, chunk_size=DEFAULT_CHUNK_SIZE, deadline=TASK_DEADLINE):
+        """ Async version of PnpProject.update_devices, the chunks are sent and waited on concurrently
+        """
+        pending = []
+        for item in devices:
+            if isinstance(item, PnpDevice):
+                pending.append((item, item.create_device_parameters()))
+                continue
+            device = self.device_list.get_by_id(item.get('id'))
+            if device is None:
+                device = AsyncPnpDevice()
+                device_parameters = dict(item)
+            else:
+                device_parameters = device.create_device_parameters()
+                device_parameters.update(item)
+            pending.append((device, device_parameters))
+
+        chunks = [pending[start:start + chunk_size] for start in range(0, len(pending), chunk_size)]
+        await asyncio.gather(*[self._update_chunk(chunk, deadline) for chunk in chunks])
+        await self.get_project_by_id(self.id, False)
+        return [device for device, device_parameters in pending]
+
+    async def _update_chunk(self, chunk, deadline):
+        response = await async_make_rest_call(self.client, PUT, '/api/v1/pnp-project/' + self.id + '/device',
+                                              [device_parameters for device, device_parameters in chunk])
+        if not response or 'taskId' not in response['response']:
+            for device, device_parameters in chunk:
+                self._device_failed(device, device_parameters, 'Unable to update device', 'Error Updating Device: ')
+            return
+        task_status = await async_get_task_id(self.client, response['response']['taskId'], deadline)
+        if task_status['isError'] and len(chunk) > 1:
+            # Sent again one device at a time, so only the devices that caused the error fail
+            await asyncio.gather(*[self._update_chunk([item], deadline) for item in chunk])
+        elif task_status['isError']:
+            device, device_parameters = chunk[0]
+            self._device_failed(device, device_parameters, task_status['failureReason'], 'Error Updating Device: ')
+        else:
+            for device, device_parameters in chunk:
+                device.populate_device(device_parameters)
+                device.projectId = self.id
+                device.error = False
+                device.error_reason = ''
+                self.device_list.add(device)
+
+    async def delete_devices(self, devices, deadline=TASK_DEADLINE):
+        """ Async version of PnpProject.delete_devices, the DELETEs are sent concurrently (bounded by
+            the concurrency of the client)
+        """
+        pending = []
+        for item in devices:
+            if not isinstance(item, PnpDevice):
+                device = self.device_list.get_by_id(item)
+                if device is None:
+                    device = AsyncPnpDevice()
+                    device.id = item
+                item = device
+            pending.append(item)
+
+        async def delete(device):
+            if device.id is None:
+                self._device_failed(device, {'hostName': device.hostName}, 'Device has no id', 'Error Deleting Device: ')
+                return
+            response = await async_make_rest_call(self.client, DELETE, '/api/v1/pnp-project/' + self.id + '/device/' + device.id)
+            if not response or 'taskId' not in response['response']:
+                task_status = {'isError': True, 'failureReason': 'Unable to delete device'}
+            else:
+                task_status = await async_get_task_id(self.client, response['response']['taskId'], deadline)
+            if task_status['isError']:
+                self._device_failed(device, {'hostName': device.hostName}, task_status['failureReason'],
+                                    'Error Deleting Device: ')
+            else:
+                device.error = False
+                device.error_reason = ''
+                self.device_list.remove(device)
+
+        await asyncio.gather(*[delete(device) for device in pending])
+        await self.get_project_by_id(self.id, False)
+        return pending
+
+    async def get_device_details(self):
+        return [deviceDetail async for deviceDetail in self.iter_device_details()]
+
+    async def find_device_detail(self, device_parameters):
+        key = _device_key(device_parameters)
+        if key is None:
+            return None
+        try:
+            async for deviceDetail in self.iter_device_details():
+                if _device_key(deviceDetail) == key:
+                    return deviceDetail
+        except PnpListingError as e:
+            print('Error: ' + str(e))
+        return None
+
+    def iter_device_details(self, page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+        return async_iter_pages(self.client, '/api/v1/pnp-project/' + self.id + '/device', page_size)
+
+    async def iter_devices(self, page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+        async for deviceDetail in self.iter_device_details(page_size):
+            device = AsyncPnpDevice()
+            device.projectId = self.id
+            device.populate_device(deviceDetail)
+            yield device
+
+    async def get_project_by_name(self, name):
+        try:
+            async for project in async_iter_pages(self.client, '/api/v1/pnp-project'):
+                if project['siteName'] == name:
+                    return await self.get_project_by_id(project['id'])
+        except PnpListingError as e:
+            print('Error: ' + str(e))
+            return None
+
+        print('Unable to locate Project: ' + name)
+        return None
+
+    async def get_project_by_id(self, id, get_devices=True):
+        response = await async_make_rest_call(self.client, GET, '/api/v1/pnp-project/' + id)
+        if not response:
+            print('Error: Unable to get Project: ' + id)
+            return None
+        value = response['response']
+        if 'errorCode' in value:
+            print('Error: Unable to get Project: ' + value['message'] + ' (' + value['detail'] + ')')
+            return None
+
+        self.id = id
+        self.populate_project(value)
+
+        if get_devices:
+            self.device_list.clear()
+        if get_devices and self.deviceCount > 0:
+            try:
+                async for device in self.iter_devices():
+                    self.device_list.add(device)
+            except PnpListingError as e:
+                print('Error: ' + str(e))
+                self.error = True
+                self.error_reason = str(e)
+                return None
+        return id
+
+class AsyncPnpDevice(PnpDevice):
+    __slots__ = ()
+
+    async def create_device(self, project, device_parameters=None):
+        if device_parameters is None:
+            device_parameters = self.create_device_parameters()
+
+        response = await async_make_rest_call(project.client, POST, '/api/v1/pnp-project/' + project.id + '/device', [device_parameters])
+        if not response or 'taskId' not in response['response']:
+            self.error = True
+            self.error_reason = 'Unable to add device to Project'
+            return None
+        task_status = await async_get_task_id(project.client, response['response']['taskId'])
+
+        if (task_status['isError']):
+            self.error = True
+            self.error_reason = task_status['failureReason']
+            return None
+        self.projectId = project.id
+        rule_ids = get_task_rule_ids(task_status)
+        if rule_ids:
+            self.populate_device(device_parameters)
+            self.id = rule_ids[0]
+        else:
+            deviceDetail = await project.find_device_detail(device_parameters)
+            if deviceDetail is None:
+                self.error = True
+                self.error_reason = 'Unable to locate device after adding it to Project'
+                return None
+            self.populate_device(deviceDetail)
+        print('Device Added to Project: ' + str(self.hostName) + ' (' + self.id + ') added to Project ' + project.siteName + ' (' + project.id + ')')
+
+    async def update_device(self, project, device_parameters=None):
+        if device_parameters is None:
+            device_parameters = self.create_device_parameters()
+
+        response = await async_make_rest_call(project.client, PUT, '/api/v1/pnp-project/' + project.id + '/device', [device_parameters])
+        if not response or 'taskId' not in response['response']:
+            self.error = True
+            self.error_reason = 'Unable to update device'
+            return None
+        task_status = await async_get_task_id(project.client, response['response']['taskId'])
+
+        if (task_status['isError']):
+            self.error = True
+            self.error_reason = task_status['failureReason']
+            return None
+        self.error = False
+        self.error_reason = ''
+        self.projectId = project.id
+        self.populate_device(device_parameters)
+        project.device_list.add(self)
+        return self.id
+
+    async def delete_device(self, project):
+        response = await async_make_rest_call(project.client, DELETE, '/api/v1/pnp-project/' + project.id + '/device/' + self.id)
+        if not response or 'taskId' not in response['response']:
+            self.error = True
+            self.error_reason = 'Unable to delete device'
+            return None
+        task_status = await async_get_task_id(project.client, response['response']['taskId'])
+
+        if (task_status['isError']):
+            self.error = True
+            self.error_reason = task_status['failureReason']
+            return None
+        self.error = False
+        self.error_reason = ''
+        project.device_list.remove(self)
+        return True
+
+    async def populate_device_from_apic(self, deviceId, project, deviceDetail=None):
+        if deviceId is not None and deviceDetail is None:
+            async for devicesDetail in project.iter_device_details():
+                if devicesDetail.get('id') == deviceId:
+                    deviceDetail = devicesDetail
+                    break
+        self.populate_device(deviceDetail)
@@ -6,6 +6,20 @@ import sys
 import os
 import traceback
 import ast
+import csv
+import threading
+import hashlib
+import hmac
+import uuid
+import operator
+import queue
+import re
+import sqlite3
+from array import array
+from collections.abc import MutableMapping
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 DEBUG = False
 requests.packages.urllib3.disable_warnings()
@@ -15,37 +29,673 @@ POST = 'post'
 PUT = 'put'
 DELETE = 'delete'
 
-def pnp_login(username, password, server):
-    """ Service Ticket is used for authorization for all REST Calls throughout the script
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+DEFAULT_CHUNK_SIZE = 50
+
+# Tasks are polled right away, then every TASK_POLL_INTERVAL seconds growing by TASK_POLL_BACKOFF
+# up to TASK_POLL_MAX_INTERVAL, until TASK_DEADLINE seconds have passed
+TASK_POLL_INTERVAL = 0.1
+TASK_POLL_MAX_INTERVAL = 2
+TASK_POLL_BACKOFF = 1.5
+TASK_DEADLINE = 60
+
+DEFAULT_PAGE_SIZE = 500
+
+# Seconds before PnpFileHandler downloads a file namespace again, and before a missed lookup is retried
+FILE_CACHE_TTL = 300
+FILE_NEGATIVE_CACHE_TTL = 30
+
+# File record fields PnpFileHandler can look files up by
+FILE_INDEX_KEYS = ('name', 'id', 'md5Checksum', 'sha1Checksum')
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Seconds a PnpFileManifest is trusted before it is checked against the file namespace again
+MANIFEST_MAX_AGE = 24 * 60 * 60
+
+DEFAULT_WORKERS = 8
+
+# PnpConcurrencyController: calls in flight at first and its bounds, what the limit is multiplied by
+# when the server is overloaded, and how much slower than usual tasks may get before it is
+CONCURRENCY_INITIAL = 4
+CONCURRENCY_MIN = 1
+CONCURRENCY_MAX = 64
+CONCURRENCY_DECREASE = 0.7
+CONCURRENCY_TASK_TOLERANCE = 2.0
+
+# Service tickets are cached here per server and user, so scripts don't have to log in on every run
+TICKET_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.pnp_tickets.json')
+# APIC-EM ticket lifetimes, used when the ticket response doesn't include them
+DEFAULT_IDLE_TIMEOUT = 1800
+DEFAULT_SESSION_TIMEOUT = 21600
+# Seconds before it times out that a ticket is treated as expired
+TICKET_EXPIRY_MARGIN = 60
+# PBKDF2 iterations of the password hash a cached ticket is checked against
+TICKET_HASH_ITERATIONS = 100000
+
+# Upper bounds (seconds) of the latency histogram buckets of PnpMetrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# A watched project is polled every WATCH_INTERVAL seconds after a change, growing by WATCH_BACKOFF
+# up to WATCH_MAX_INTERVAL while nothing changes
+WATCH_INTERVAL = 2
+WATCH_MAX_INTERVAL = 60
+WATCH_BACKOFF = 1.5
+
+# Device states reported as errors by watch and FleetSnapshot
+DEVICE_ERROR_STATES = frozenset(('ERROR',))
+# Device record fields holding why a device is in error, the first one set is used
+DEVICE_ERROR_REASON_FIELDS = ('errorMessage', 'stateDisplay')
+
+# Device fields PnpStateCache keeps in indexed columns, other fields are read from the JSON record
+CACHE_DEVICE_COLUMNS = ('hostName', 'serialNumber', 'state', 'platformId')
+
+# Items a ProvisioningPipeline stage may have waiting before the stage feeding it blocks
+PIPELINE_QUEUE_SIZE = 100
+
+# Manifest rows import_manifest reads ahead and adds together, memory use grows with it and not with
+# the size of the manifest
+MANIFEST_BATCH_SIZE = 500
+# Manifest columns accepted for the device parameters they stand for
+MANIFEST_ALIASES = {'image': 'imageName', 'config': 'configName'}
+# Fields of the rows of the import_manifest result log
+MANIFEST_RESULT_FIELDS = ('line', 'hostName', 'serialNumber', 'status', 'id', 'error_reason')
+
+# APIC-EM PnP Project attributes, in the order they are sent to APIC-EM
+PROJECT_FIELDS = ('id', 'state', 'provisionedBy', 'provisionedOn', 'siteName', 'tftpServer', 'tftpPath', 'note',
+                  'deviceCount', 'pendingDeviceCount', 'deviceLastUpdate', 'installerUserID')
+
+# APIC-EM PnP Device attributes, in the order they are sent to APIC-EM
+DEVICE_FIELDS = ('state', 'authStatus', 'lastContact', 'deviceId', 'lastStateTransitionTime', 'stateDisplay',
+                 'hostName', 'serialNumber', 'tag', 'id', 'platformId', 'site', 'imageId', 'configId', 'bootStrapId',
+                 'licenseString', 'apCount', 'isMobilityController', 'pkiEnabled', 'sudiRequired',
+                 'connectedToDeviceId', 'connectedToPortId', 'connectedToPortName', 'connetedToLocationCivicAddr',
+                 'imagePreference', 'connectedToDeviceHostName', 'connetedToLocationGeoAddr', 'configPreference',
+                 'attributeInfo')
+
+# Device attributes that usually repeat across the devices of a project
+DEVICE_SHARED_FIELDS = frozenset(('state', 'authStatus', 'stateDisplay', 'platformId', 'site', 'imageId', 'bootStrapId',
+                                  'licenseString', 'apCount', 'isMobilityController', 'pkiEnabled',
+                                  'sudiRequired', 'imagePreference', 'configPreference', 'tag'))
+
+# Device parameters that refer to a file by name: {name field: (id field, file type)}
+DEVICE_FILE_FIELDS = {'configName': ('configId', 'config'), 'imageName': ('imageId', 'image')}
+
+_PROJECT_FIELD_SET = frozenset(PROJECT_FIELDS)
+_DEVICE_FIELD_SET = frozenset(DEVICE_FIELDS)
+_project_values = operator.attrgetter(*PROJECT_FIELDS)
+_device_values = operator.attrgetter(*DEVICE_FIELDS)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Instrumentation hooks, replaced (never modified) by add_hook and remove_hook
+_hooks = ()
+_hooks_lock = threading.Lock()
+_id_pattern = re.compile(r'/(?:[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}|[0-9]+)(?=/|$)')
+
+
+class PnpConcurrencyController:
+    """ PnpConcurrencyController limits how many REST calls are in flight to an APIC-EM server and
+        adapts the limit to how the server is coping (AIMD: additive increase, multiplicative decrease).
+
+        The limit grows by one every limit calls while the calls it allows are all in use and healthy
+        (doubling every round of calls until the server first pushes back).  It is multiplied by
+        decrease when a call fails (no response, 429, 5xx or a retried status), when the smoothed
+        latency goes over latency_target (None to ignore latency), or when tasks take more than
+        task_tolerance times as long as they used to.  Calls already in flight when the
+        server was overloaded report it too, so the limit is decreased at most once per latency.
+        max_rate is an optional hard cap of requests per second, and a 429 with Retry-After pauses
+        every call for that long.
+
+        A controller is given to PnpClient (or pnp_login) as controller=, and applies to every call
+        made through the client, so several threads (ex: the workers of fleet_snapshot or sync) can
+        share one: give them more workers than the limit and the controller decides how many run.
+    """
+    def __init__(self, initial=CONCURRENCY_INITIAL, min_concurrency=CONCURRENCY_MIN, max_concurrency=CONCURRENCY_MAX,
+                 latency_target=None, max_rate=None, decrease=CONCURRENCY_DECREASE,
+                 task_tolerance=CONCURRENCY_TASK_TOLERANCE):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_target = latency_target
+        self.max_rate = max_rate
+        self.decrease = decrease
+        self.task_tolerance = task_tolerance
+        self.limit = float(min(max(initial, min_concurrency), max_concurrency))
+        self.in_flight = 0
+        self.decreases = 0
+        self.latency = None
+        self.task_time = None
+        self._task_baseline = None
+        self._last_decrease = 0
+        self._next_send = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """ Waits for a free slot (and the rate cap) and returns the time the call may start
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            send_at = self._next_send
+            if self.max_rate:
+                self._next_send = max(time.time(), self._next_send) + 1.0 / self.max_rate
+        delay = send_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return time.time()
+
+    def release(self, start, response):
+        """ Frees the slot of a call started at start, response is None if none was received
+        """
+        now = time.time()
+        latency = now - start
+        status = response.status_code if response is not None else None
+        with self._condition:
+            # The call was using the last slot, so a larger limit would have been used
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            self.latency = latency if self.latency is None else self.latency * 0.8 + latency * 0.2
+            if status is None or status == 429 or status >= 500 or _request_retries(response):
+                self._decrease(now)
+                if status == 429:
+                    self._pause(now, response.headers.get('Retry-After'))
+            elif self.latency_target is not None and self.latency > self.latency_target:
+                self._decrease(now)
+            elif saturated and not self.decreases:
+                # Until the server first pushes back the limit doubles every round of calls
+                self.limit = min(self.max_concurrency, self.limit + 1)
+            elif saturated:
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def record_task(self, seconds):
+        """ Records how long a task took to complete, tasks slowing down means the server is busy
+        """
+        with self._condition:
+            self.task_time = seconds if self.task_time is None else self.task_time * 0.8 + seconds * 0.2
+            if self._task_baseline is None or self.task_time < self._task_baseline:
+                self._task_baseline = self.task_time
+            elif self.task_time > self.task_tolerance * self._task_baseline:
+                self._decrease(time.time())
+                # The baseline follows slowly, so a server that stays slower stops shrinking the limit
+                self._task_baseline = self._task_baseline * 0.9 + self.task_time * 0.1
+
+    def _decrease(self, now):
+        if now - self._last_decrease < (self.latency or 0):
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_concurrency, self.limit * self.decrease)
+        self.decreases += 1
+
+    def _pause(self, now, retry_after):
+        try:
+            self._next_send = max(self._next_send, now + float(retry_after))
+        except (TypeError, ValueError):
+            pass
+
+    def stats(self):
+        with self._condition:
+            return {'limit': int(self.limit), 'in_flight': self.in_flight, 'latency': self.latency,
+                    'task_time': self.task_time, 'decreases': self.decreases}
+
+
+class PnpClient:
+    """ PnpClient holds a pooled, keep-alive requests.Session to a single APIC-EM server.
+
+        All REST calls made through make_rest_call share the connection pool of the client, so the
+        TCP+TLS handshake is only paid once per pooled connection instead of once per call.
+        For backwards compatibility the client can be used anywhere the old credentials dict was
+        expected (client['ticket'], client['server']).
+    """
+    def __init__(self, server, ticket=None, pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR, verify=False, timeout=None, ticket_provider=None,
+                 scheme='https', controller=None):
+        self.server = server
+        self.ticket = ticket
+        self.ticket_provider = ticket_provider
+        self.verify = verify
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.scheme = scheme
+        self.base_url = scheme + '://' + server
+        self.controller = controller
+        if controller is not None:
+            # Enough pooled connections for every call the controller may let through
+            pool_size = max(pool_size, controller.max_concurrency)
+            self.pool_size = pool_size
+
+        # Only idempotent methods are retried on a bad status, connection errors are retried for all
+        retry = Retry(total=retries, connect=retries, read=retries, backoff_factor=backoff_factor,
+                      status_forcelist=RETRY_STATUS_CODES, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Connection': 'keep-alive'})
+
+    def request(self, command, url, **kwargs):
+        kwargs.setdefault('verify', self.verify)
+        kwargs.setdefault('timeout', self.timeout)
+        if self.controller is None:
+            return self.session.request(command.upper(), self.base_url + url, **kwargs)
+        start = self.controller.acquire()
+        response = None
+        try:
+            response = self.session.request(command.upper(), self.base_url + url, **kwargs)
+            return response
+        finally:
+            self.controller.release(start, response)
+
+    def refresh_ticket(self, stale_ticket):
+        """ Replaces a ticket APIC-EM rejected with a new one from the ticket provider.  Returns the
+            new ticket, or None if there is no provider or it couldn't log in
+        """
+        if self.ticket_provider is None:
+            return None
+        ticket = self.ticket_provider.refresh(stale_ticket)
+        if ticket is not None:
+            self.ticket = ticket
+        return ticket
+
+    def close(self):
+        self.session.close()
+
+    # Old credentials dict interface
+    def __getitem__(self, key):
+        if key == 'ticket':
+            return self.ticket
+        if key == 'server':
+            return self.server
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in ('ticket', 'server')
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+def get_client(credentials):
+    """ Returns the PnpClient for credentials.  credentials can be a PnpClient or an old style
+        {'ticket', 'server'} dict, in which case a shared client is kept per server and ticket.
+    """
+    if isinstance(credentials, PnpClient):
+        return credentials
+    key = (credentials['server'], credentials['ticket'])
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = PnpClient(credentials['server'], credentials['ticket'])
+            _clients[key] = client
+        return client
+
+
+# Fields of a PnpTicketProvider cache entry
+_TICKET_ENTRY_FIELDS = ('ticket', 'issued', 'lastUsed', 'idleTimeout', 'sessionTimeout', 'salt', 'passwordHash')
+
+
+class PnpTicketProvider:
+    """ PnpTicketProvider logs in to an APIC-EM server as one user and hands out its service ticket.
+
+        Tickets are cached in a JSON file (cache_path, None to keep them in memory only) per server
+        and user, along with when they were issued and last used, so the next run reuses the ticket
+        until its idle or session timeout instead of logging in again.  The password is never
+        written to the cache, only a salted hash of it, and a cached ticket is only used when the
+        password matches that hash.  refresh is called when APIC-EM rejects the ticket; when several
+        threads hit the expired ticket at once only the first one logs in.
+    """
+    def __init__(self, username, password, server, cache_path=TICKET_CACHE_PATH, client=None):
+        self.username = username
+        self.password = password
+        self.server = server
+        self.cache_path = cache_path
+        self.client = client
+        self.ticket = None
+        self.issued = None
+        self.last_used = None
+        self.idle_timeout = DEFAULT_IDLE_TIMEOUT
+        self.session_timeout = DEFAULT_SESSION_TIMEOUT
+        self._saved = None
+        self._salt = None
+        self._password_hash = None
+        self._key = server + ' ' + username
+        self._lock = threading.Lock()
+
+    def get_ticket(self):
+        """ Returns a ticket that hasn't expired, from memory, the cache file or a new login
+        """
+        with self._lock:
+            if not self.is_valid():
+                self._load()
+            if not self.is_valid():
+                self._login()
+            return self.ticket
+
+    def refresh(self, stale_ticket=None):
+        """ Logs in again and returns the new ticket, unless another thread already replaced stale_ticket
+        """
+        with self._lock:
+            if self.ticket is not None and self.ticket != stale_ticket:
+                return self.ticket
+            self._login()
+            return self.ticket
+
+    def touch(self):
+        """ Records that the ticket was just used, which restarts its idle timeout
+        """
+        self.last_used = time.time()
+        # Written back to the cache now and then, not on every request
+        if self._saved is not None and self.last_used - self._saved > self.idle_timeout / 10:
+            with self._lock:
+                self._save()
+
+    def is_valid(self):
+        if self.ticket is None:
+            return False
+        now = time.time()
+        return (now - self.last_used < self.idle_timeout - TICKET_EXPIRY_MARGIN and
+                now - self.issued < self.session_timeout - TICKET_EXPIRY_MARGIN)
+
+    def _login(self):
+        if self.client is None:
+            self.client = PnpClient(self.server)
+        self.ticket = None
+        response = request_ticket(self.client, self.username, self.password)
+        if response is None:
+            return
+        self.ticket = response['serviceTicket']
+        self.issued = self.last_used = time.time()
+        self.idle_timeout = response.get('idleTimeout', DEFAULT_IDLE_TIMEOUT)
+        self.session_timeout = response.get('sessionTimeout', DEFAULT_SESSION_TIMEOUT)
+        self._save()
+
+    def _read_cache(self):
+        if self.cache_path is None or not os.path.isfile(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path) as cache_file:
+                cache = json.load(cache_file)
+        except ValueError:
+            return {}
+        if not isinstance(cache, dict):
+            return {}
+        # Entries that aren't what _save writes are dropped
+        return dict((key, entry) for key, entry in cache.items()
+                    if isinstance(entry, dict) and all(field in entry for field in _TICKET_ENTRY_FIELDS))
+
+    def _hash_password(self, salt):
+        return hashlib.pbkdf2_hmac('sha256', self.password.encode('utf-8'), bytes.fromhex(salt),
+                                   TICKET_HASH_ITERATIONS).hex()
+
+    def _load(self):
+        entry = self._read_cache().get(self._key)
+        if entry is None:
+            return
+        try:
+            password_hash = self._hash_password(entry['salt'])
+        except (TypeError, ValueError):
+            return
+        # A ticket cached for another password is not handed out
+        if not hmac.compare_digest(password_hash, str(entry['passwordHash'])):
+            return
+        self._salt = entry['salt']
+        self._password_hash = password_hash
+        self.ticket = entry['ticket']
+        self.issued = entry['issued']
+        self.last_used = entry['lastUsed']
+        self.idle_timeout = entry['idleTimeout']
+        self.session_timeout = entry['sessionTimeout']
+        self._saved = time.time()
+
+    def _save(self):
+        self._saved = time.time()
+        if self.cache_path is None or self.ticket is None:
+            return
+        # Other servers and users may share the cache, so it is read again and only this entry replaced
+        cache = self._read_cache()
+        if self._password_hash is None:
+            self._salt = os.urandom(16).hex()
+            self._password_hash = self._hash_password(self._salt)
+        cache[self._key] = {'ticket': self.ticket, 'issued': self.issued, 'lastUsed': self.last_used,
+                            'idleTimeout': self.idle_timeout, 'sessionTimeout': self.session_timeout,
+                            'salt': self._salt, 'passwordHash': self._password_hash}
+        now = time.time()
+        for key, entry in list(cache.items()):
+            if now - entry['lastUsed'] > entry['idleTimeout'] or now - entry['issued'] > entry['sessionTimeout']:
+                del cache[key]
+        # The tickets are credentials, the file is only readable by the user.  It is written to a
+        # temporary file first so concurrent runs never read a half written cache
+        tmp_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cache_file:
+            json.dump(cache, cache_file, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
+
+
+def request_ticket(client, username, password):
+    """ Logs in and returns the ticket response ({'serviceTicket', 'idleTimeout', 'sessionTimeout'}),
+        or None if the login failed
     """
-    ticket = None
     payload = {'username': username, 'password': password}
-    url = 'https://' + server + '/api/v1/ticket'
+    url = '/api/v1/ticket'
 
     # Content type must be included in the header
     header = {'content-type': 'application/json'}
 
     # Format the payload to JSON and add to the data.  Include the header in the call.
     # SSL certification is turned off, but should be active in production environments
-    response = requests.post(url, data=json.dumps(payload), headers=header, verify=False)
+    response = client.request(POST, url, data=json.dumps(payload), headers=header)
 
     # Check if a response was received. If not, print(an error message.)
     if(not response):
-        print(('No data returned! ' + url))
+        print(('No data returned! ' + client.base_url + url))
         return None
     else:
-        # Data received.  Get the ticket and print(to screen.)
-        r_json = response.json()
-        ticket = r_json['response']['serviceTicket']
-        return {'ticket': ticket, 'server': server}
+        # Data received.  Get the ticket
+        return response.json()['response']
+
+
+def pnp_login(username, password, server, ticket_cache=TICKET_CACHE_PATH, **client_options):
+    """ Service Ticket is used for authorization for all REST Calls throughout the script
+
+        Returns a PnpClient (usable as the old credentials dict) holding the ticket and the
+        connection pool for the server.  client_options are passed to PnpClient
+        (pool_size, retries, backoff_factor, verify, timeout, scheme, controller).
+
+        The ticket is reused from ticket_cache (a file, None to always log in) while it is valid, and
+        when it expires during a run the client logs in again and replays the rejected request.
+    """
+    client = PnpClient(server, **client_options)
+    client.ticket_provider = PnpTicketProvider(username, password, server, ticket_cache, client)
+    client.ticket = client.ticket_provider.get_ticket()
+    if client.ticket is None:
+        return None
+    return client
+
+
+class PnpHook:
+    """ Base class of instrumentation hooks, see add_hook.  Override the methods you need.
+    """
+    def on_request(self, command, endpoint, status, seconds, bytes_out, bytes_in, retries, error):
+        """ Called after every REST call.  endpoint is the url template (endpoint_template), status
+            is None if no response was received, retries counts the connection/status retries and
+            ticket refreshes, and error is True if the call failed
+        """
+        pass
+
+    def on_task(self, task_id, seconds, polls, task_status):
+        """ Called when a task wait (get_task_id or TaskWaiter) ends, seconds after it started
+        """
+        pass
+
+
+def add_hook(hook):
+    """ Registers a PnpHook, it is called from every thread that makes REST calls or waits on tasks.
+        With no hooks registered the REST calls aren't timed at all.
+    """
+    global _hooks
+    with _hooks_lock:
+        _hooks = _hooks + (hook,)
+    return hook
+
+
+def remove_hook(hook):
+    global _hooks
+    with _hooks_lock:
+        _hooks = tuple(h for h in _hooks if h is not hook)
+
+
+def endpoint_template(url):
+    """ Returns url without its query string and with the ids replaced by {id},
+        ex: /api/v1/pnp-project/{id}/device
+    """
+    return _id_pattern.sub('/{id}', url.split('?', 1)[0])
+
+
+def _request_retries(response):
+    # urllib3 records the retries it made on the response
+    retries = getattr(getattr(response, 'raw', None), 'retries', None)
+    if retries is None or not hasattr(retries, 'history'):
+        return 0
+    return len(retries.history)
+
+
+def _call_hooks(method, *args):
+    for hook in _hooks:
+        try:
+            getattr(hook, method)(*args)
+        except Exception:
+            traceback.print_exc()
+
 
+class PnpMetrics(PnpHook):
+    """ PnpMetrics counts the REST calls and task waits per endpoint template: number of calls,
+        errors, retries, bytes sent and received and a latency histogram (buckets LATENCY_BUCKETS).
 
-def make_rest_call(credentials, command, url, aData=None, files=None):
+        summary() returns it all as a dictionary, to_json() as JSON and to_prometheus() in the
+        Prometheus text format.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.requests = {}
+        self.tasks = self._new_stats()
+        self._lock = threading.Lock()
+
+    def _new_stats(self):
+        return {'count': 0, 'errors': 0, 'retries': 0, 'bytes_out': 0, 'bytes_in': 0, 'seconds': 0.0,
+                'polls': 0, 'buckets': [0] * (len(self.buckets) + 1)}
+
+    def _observe(self, stats, seconds):
+        stats['count'] += 1
+        stats['seconds'] += seconds
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        stats['buckets'][i] += 1
+
+    def on_request(self, command, endpoint, status, seconds, bytes_out, bytes_in, retries, error):
+        key = (command.upper(), endpoint)
+        with self._lock:
+            stats = self.requests.get(key)
+            if stats is None:
+                stats = self.requests[key] = self._new_stats()
+            self._observe(stats, seconds)
+            stats['retries'] += retries
+            stats['bytes_out'] += bytes_out
+            stats['bytes_in'] += bytes_in
+            if error:
+                stats['errors'] += 1
+
+    def on_task(self, task_id, seconds, polls, task_status):
+        with self._lock:
+            self._observe(self.tasks, seconds)
+            self.tasks['polls'] += polls
+            if task_status.get('isError'):
+                self.tasks['errors'] += 1
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}
+            self.tasks = self._new_stats()
+
+    def _summarize(self, stats):
+        summary = dict((key, value) for key, value in stats.items() if key != 'buckets')
+        summary['average'] = stats['seconds'] / stats['count'] if stats['count'] else 0.0
+        summary['histogram'] = [list(bucket) for bucket in zip(list(self.buckets) + ['+Inf'], stats['buckets'])]
+        return summary
+
+    def summary(self):
+        with self._lock:
+            requests = [dict(method=method, endpoint=endpoint, **self._summarize(stats))
+                        for (method, endpoint), stats in sorted(self.requests.items())]
+            for summary in requests:
+                del summary['polls']
+            tasks = self._summarize(self.tasks)
+            del tasks['bytes_out'], tasks['bytes_in'], tasks['retries']
+        return {'requests': requests, 'tasks': tasks}
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=1, sort_keys=True)
+
+    def to_prometheus(self, prefix='pnp'):
+        with self._lock:
+            requests = sorted((key, dict(stats, buckets=list(stats['buckets']))) for key, stats in self.requests.items())
+            tasks = dict(self.tasks, buckets=list(self.tasks['buckets']))
+        lines = []
+
+        def histogram(name, help, series):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s histogram' % (prefix, name))
+            for labels, stats in series:
+                cumulative = 0
+                for bound, count in zip([str(bound) for bound in self.buckets] + ['+Inf'], stats['buckets']):
+                    cumulative += count
+                    lines.append('%s_%s_bucket{%sle="%s"} %d' % (prefix, name, labels + ',' if labels else '', bound, cumulative))
+                lines.append('%s_%s_sum{%s} %f' % (prefix, name, labels, stats['seconds']))
+                lines.append('%s_%s_count{%s} %d' % (prefix, name, labels, stats['count']))
+
+        def counter(name, help, field, series):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            for labels, stats in series:
+                lines.append('%s_%s{%s} %d' % (prefix, name, labels, stats[field]))
+
+        series = [('method="%s",endpoint="%s"' % key, stats) for key, stats in requests]
+        histogram('request_seconds', 'APIC-EM REST call latency', series)
+        counter('request_errors_total', 'APIC-EM REST calls that failed', 'errors', series)
+        counter('request_retries_total', 'APIC-EM REST call retries', 'retries', series)
+        counter('request_bytes_sent_total', 'Bytes sent to APIC-EM', 'bytes_out', series)
+        counter('request_bytes_received_total', 'Bytes received from APIC-EM', 'bytes_in', series)
+        histogram('task_wait_seconds', 'Time waiting for APIC-EM tasks to complete', [('', tasks)])
+        counter('task_polls_total', 'APIC-EM task polls', 'polls', [('', tasks)])
+        counter('task_errors_total', 'APIC-EM tasks that failed or timed out', 'errors', [('', tasks)])
+        return '\n'.join(lines) + '\n'
+
+
+def make_rest_call(credentials, command, url, aData=None, files=None, stream=None):
     """ make_rest_call is for simplifying REST calls to APIC-EM
+
+        credentials can be a PnpClient or the old {'ticket', 'server'} dict
+        stream is a MultipartFileStream to send as the body of a POST, instead of files
+        If APIC-EM rejects the ticket and the client has a ticket provider (see pnp_login), the
+        ticket is refreshed once and the request sent again.
     """
     response_json = None
     payload = None
-    api_url = 'https://' + credentials['server'] + url
+    client = get_client(credentials)
+    api_url = client.base_url + url
+    start = time.time() if _hooks else None
+    r = None
+    retries = 0
     try:
         # if data for the body is passed in put into JSON format for the payload
         if(aData is not None):
@@ -53,31 +703,54 @@ def make_rest_call(credentials, command, url, aData=None, files=None):
 
         # add the service ticket and content type to the header
         if files is not None:
-            header = {'X-Auth-Token': credentials['ticket']}
-        else:
-            header = {'X-Auth-Token': credentials['ticket'], 'content-type': 'application/json'}
-
-        if(command == GET):
-            r = requests.get(api_url, data=payload, headers=header, verify=False)
-            if DEBUG:
-                print(api_url, payload, header)
-
-        elif(command == POST):
-            if files is not None:
-                r = requests.post(api_url, data=payload, headers=header, files=files, verify=False)            
-            else:
-                r = requests.post(api_url, data=payload, headers=header, verify=False)
-            if DEBUG:
-                print(api_url, payload, header)
-        elif(command == PUT):
-            r = requests.put(api_url, data=payload, headers=header, verify=False)
-        elif(command == DELETE):
-            r = requests.delete(api_url, data=payload, headers=header, verify=False)            
+            header = {'X-Auth-Token': client.ticket}
+        elif stream is not None:
+            header = {'X-Auth-Token': client.ticket, 'content-type': stream.content_type}
+            payload = stream
         else:
+            header = {'X-Auth-Token': client.ticket, 'content-type': 'application/json'}
+
+        def send():
+            if(command == GET):
+                r = client.request(GET, url, data=payload, headers=header)
+                if DEBUG:
+                    print(api_url, payload, header)
+
+            elif(command == POST):
+                if files is not None:
+                    r = client.request(POST, url, data=payload, headers=header, files=files)
+                else:
+                    r = client.request(POST, url, data=payload, headers=header)
+                if DEBUG:
+                    print(api_url, payload, header)
+            elif(command == PUT):
+                r = client.request(PUT, url, data=payload, headers=header)
+            elif(command == DELETE):
+                r = client.request(DELETE, url, data=payload, headers=header)
+            return r
+
+        if command not in (GET, POST, PUT, DELETE):
             # if the command is not GET or POST we don't handle it.
             print('Unknown command!')
             return None
 
+        r = send()
+        if r.status_code == 401 and client.refresh_ticket(header['X-Auth-Token']) is not None:
+            # The ticket expired, send the request again with the new one
+            header['X-Auth-Token'] = client.ticket
+            if stream is not None:
+                stream.rewind()
+            if files is not None:
+                _rewind_files(files)
+            retries = _request_retries(r) + 1
+            r = send()
+        if client.ticket_provider is not None and r.status_code != 401:
+            client.ticket_provider.touch()
+        if start is not None:
+            bytes_out = int(r.request.headers.get('Content-Length') or 0)
+            _call_hooks('on_request', command, endpoint_template(url), r.status_code, time.time() - start,
+                        bytes_out, len(r.content), retries + _request_retries(r), not r)
+
         # if no data is returned print(a message; otherwise print(data to the screen)
         if(not r):
             print('No data returned! ' + url)
@@ -91,127 +764,1264 @@ def make_rest_call(credentials, command, url, aData=None, files=None):
         #print(response_json)
         return response_json
     except:
+        if start is not None and r is None:
+            _call_hooks('on_request', command, endpoint_template(url), None, time.time() - start, 0, 0, retries, True)
         err = sys.exc_info()[0]
         msg_det = sys.exc_info()[1]
         print('Error: %s  Details: %s StackTrace: %s' %
               (err, msg_det, traceback.format_exc()))
 
 
+def _rewind_files(files):
+    for value in files.values():
+        file_object = value[1] if isinstance(value, tuple) else value
+        if hasattr(file_object, 'seek'):
+            file_object.seek(0)
+
 
-def get_task_id(credentials, task_id):
+def poll_task(credentials, task_id):
+    """ Polls a task once.  Returns the task status if the task has completed (or can't be
+        retrieved), or None if it is still running
+    """
     response = make_rest_call(credentials, GET, '/api/v1/task/' + task_id)
     if(not response):
         return {'isError': True, 'failureReason': 'Unable to retrieve task_id'}
-    else:
-        retry_count = 0
-        while ('endTime' not in response['response']) and retry_count < 10:
-            time.sleep(2)
-            response = make_rest_call(credentials, GET, '/api/v1/task/' + task_id)
-            retry_count += 1
-
-        if ('endTime' not in response['response']):
-            return {'isError': True, 'failureReason': 'Task did not complete in 20 seconds'}
-        else:
-            return response['response']
+    if 'endTime' not in response['response']:
+        return None
+    return response['response']
+
+
+def get_task_id(credentials, task_id, deadline=TASK_DEADLINE):
+    """ Waits for a task to complete and returns its status.  The task is polled right away and then
+        with a growing interval (TASK_POLL_INTERVAL up to TASK_POLL_MAX_INTERVAL) until deadline seconds
+    """
+    client = get_client(credentials)
+    interval = TASK_POLL_INTERVAL
+    start = time.time()
+    end_time = start + deadline
+    polls = 0
+    while True:
+        task_status = poll_task(client, task_id)
+        polls += 1
+        if task_status is None and time.time() + interval > end_time:
+            task_status = {'isError': True, 'failureReason': 'Task did not complete in %d seconds' % deadline}
+        if task_status is not None:
+            if client.controller is not None:
+                client.controller.record_task(time.time() - start)
+            if _hooks:
+                _call_hooks('on_task', task_id, time.time() - start, polls, task_status)
+            return task_status
+        time.sleep(interval)
+        interval = min(interval * TASK_POLL_BACKOFF, TASK_POLL_MAX_INTERVAL)
+
+
+class TaskWaiter:
+    """ TaskWaiter tracks many outstanding APIC-EM tasks at once.  A background thread polls every
+        task with its own adaptive interval (short at first, growing up to max_interval) until the
+        task completes or its deadline passes.
+
+        submit() returns a concurrent.futures.Future for the task status, as_completed() yields
+        (task_id, task_status) as the tasks complete and wait() returns them all as a dictionary.
+    """
+    def __init__(self, credentials, deadline=TASK_DEADLINE, interval=TASK_POLL_INTERVAL,
+                 max_interval=TASK_POLL_MAX_INTERVAL, backoff=TASK_POLL_BACKOFF, max_workers=None):
+        self.client = get_client(credentials)
+        self.deadline = deadline
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_workers = max_workers or self.client.pool_size
+        self._tasks = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def submit(self, task_id, deadline=None):
+        if deadline is None:
+            deadline = self.deadline
+        now = time.time()
+        with self._condition:
+            task = self._tasks.get(task_id)
+            if task is None:
+                task = {'future': Future(), 'next_poll': now, 'interval': self.interval,
+                        'start': now, 'end_time': now + deadline, 'deadline': deadline, 'polls': 0}
+                self._tasks[task_id] = task
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='TaskWaiter')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+            return task['future']
+
+    def as_completed(self, task_ids, deadline=None):
+        futures = {}
+        for task_id in task_ids:
+            futures[self.submit(task_id, deadline)] = task_id
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    def wait(self, task_ids, deadline=None):
+        return dict(self.as_completed(task_ids, deadline))
+
+    def _run(self):
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        completed = False
+        try:
+            while True:
+                with self._condition:
+                    if not self._tasks:
+                        self._thread = None
+                        completed = True
+                        return
+                    now = time.time()
+                    due = [task_id for task_id, task in self._tasks.items() if task['next_poll'] <= now]
+                    if not due:
+                        self._condition.wait(min(task['next_poll'] for task in self._tasks.values()) - now)
+                        continue
+
+                for task_id, task_status in zip(due, executor.map(self._poll, due)):
+                    self._update(task_id, task_status)
+        finally:
+            executor.shutdown(wait=False)
+            failed = []
+            if not completed:
+                # The loop itself failed, the waits are failed instead of hanging, and the next submit
+                # starts a new thread.  After a normal return, tasks submitted since belong to a new thread
+                with self._condition:
+                    self._thread = None
+                    failed = list(self._tasks.values())
+                    self._tasks.clear()
+            for task in failed:
+                task['future'].set_result({'isError': True, 'failureReason': 'Task polling stopped unexpectedly'})
+
+    def _poll(self, task_id):
+        try:
+            return poll_task(self.client, task_id)
+        except Exception as e:
+            return {'isError': True, 'failureReason': 'Unable to poll task: %s' % e}
+
+    def _update(self, task_id, task_status):
+        with self._condition:
+            task = self._tasks[task_id]
+            task['polls'] += 1
+            now = time.time()
+            if task_status is None and now + task['interval'] > task['end_time']:
+                task_status = {'isError': True, 'failureReason': 'Task did not complete in %d seconds' % task['deadline']}
+            if task_status is None:
+                task['next_poll'] = now + task['interval']
+                task['interval'] = min(task['interval'] * self.backoff, self.max_interval)
+                return
+            del self._tasks[task_id]
+        try:
+            if self.client.controller is not None:
+                self.client.controller.record_task(now - task['start'])
+            if _hooks:
+                _call_hooks('on_task', task_id, now - task['start'], task['polls'], task_status)
+        finally:
+            task['future'].set_result(task_status)
+
+
+def parse_task_progress(task_status):
+    """ The progress of a completed APIC-EM task is a python literal (ex: "{'ruleId': '...'}").
+        Returns the parsed progress, or None if it can't be parsed
+    """
+    try:
+        return ast.literal_eval(task_status.get('progress', ''))
+    except (ValueError, SyntaxError):
+        return None
+
+
+def get_task_rule_ids(task_status):
+    """ Returns the list of ruleIds (device ids) reported by a completed device create task, in the
+        order the devices were sent
+    """
+    progress = parse_task_progress(task_status)
+    if isinstance(progress, list):
+        return [item['ruleId'] for item in progress if isinstance(item, dict) and 'ruleId' in item]
+    if not isinstance(progress, dict):
+        return []
+    rule_ids = progress.get('ruleIds', progress.get('ruleId'))
+    if rule_ids is None:
+        return []
+    if isinstance(rule_ids, (list, tuple)):
+        return list(rule_ids)
+    return [rule_id.strip() for rule_id in str(rule_ids).split(',') if rule_id.strip()]
+
+
+class PnpListingError(Exception):
+    """ Raised by iter_pages when a page of a listing can't be read, so a listing that stopped partway
+        isn't mistaken for a complete one.  offset is the APIC-EM offset of the page that failed
+    """
+    def __init__(self, url, offset, reason):
+        Exception.__init__(self, 'Unable to get %s (offset %d): %s' % (url, offset, reason))
+        self.url = url
+        self.offset = offset
+        self.reason = reason
+
+
+def iter_pages(credentials, url, page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+    """ Generator that walks a paginated APIC-EM listing (offset/limit) and yields the records one at a
+        time, fetching each page only when it is needed.  With prefetch the next page is requested in
+        the background while the current page is consumed.  page_size should not be larger than the
+        page limit of the server (500 on APIC-EM).  Raises PnpListingError if a page can't be read,
+        after yielding the records of the pages before it.
+    """
+    client = get_client(credentials)
+    separator = '&' if '?' in url else '?'
+
+    def get_page(offset):
+        response = make_rest_call(client, GET, url + separator + 'offset=%d&limit=%d' % (offset, page_size))
+        if not response:
+            raise PnpListingError(url, offset, 'no data returned')
+        value = response['response']
+        if 'errorCode' in value:
+            raise PnpListingError(url, offset, value['message'] + ' (' + value['detail'] + ')')
+        return value
+
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        # APIC-EM offsets start at 1
+        offset = 1
+        page = get_page(offset)
+        while page:
+            offset += len(page)
+            next_page = None
+            if executor is not None and len(page) >= page_size:
+                next_page = executor.submit(get_page, offset)
+            for record in page:
+                yield record
+            if len(page) < page_size:
+                return
+            page = next_page.result() if next_page is not None else get_page(offset)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def iter_projects(credentials, page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+    """ Generator of every PnP project on the server, as PnpProject objects (without their devices)
+    """
+    for value in iter_pages(credentials, '/api/v1/pnp-project', page_size, prefetch):
+        project = PnpProject(credentials)
+        project.id = value.get('id')
+        project.populate_project(value)
+        yield project
+
+
+def file_checksum(path, algorithm='md5', chunk_size=UPLOAD_CHUNK_SIZE):
+    """ Returns the hex checksum of a file, read chunk_size bytes at a time
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as open_file:
+        for chunk in iter(lambda: open_file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-class PnpFileHandler:
-    def __init__(self, credentials):
+
+class MultipartFileStream:
+    """ A multipart/form-data body for a single file, read from disk as it is sent.
+
+        The md5 and sha1 of the file are computed as it streams, and callback(bytes_sent, total_bytes)
+        is called after each chunk of the file is read.
+    """
+    def __init__(self, path, file_name, field='file', callback=None, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.path = path
+        self.callback = callback
+        self.chunk_size = chunk_size
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + boundary
+        self._head = ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                      'Content-Type: application/octet-stream\r\n\r\n' % (boundary, field, file_name)).encode('utf-8')
+        self._tail = ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+        self.file_size = os.path.getsize(path)
+        self.len = len(self._head) + self.file_size + len(self._tail)
+        self._file = None
+        self.rewind()
+
+    def rewind(self):
+        """ Starts the body over, so the request can be sent again
+        """
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, 'rb')
+        self._buffer = self._head
+        self._tail_sent = False
+        self.bytes_sent = 0
+        self.md5 = hashlib.md5()
+        self.sha1 = hashlib.sha1()
+
+    def __len__(self):
+        return self.len
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len
+        while len(self._buffer) < size and not self._tail_sent:
+            chunk = self._file.read(min(self.chunk_size, max(size - len(self._buffer), 1)))
+            if chunk:
+                self.md5.update(chunk)
+                self.sha1.update(chunk)
+                self.bytes_sent += len(chunk)
+                if self.callback is not None:
+                    self.callback(self.bytes_sent, self.file_size)
+                self._buffer += chunk
+            else:
+                self._buffer += self._tail
+                self._tail_sent = True
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _upload_name(file_name, type):
+    """ APIC-EM requires config files to have a .txt extension, one is added if it's missing
+    """
+    if (file_name[-3:] == 'txt') or type == 'image':
+        return file_name
+    return file_name + '.txt'
+
+
+class PnpFileManifest:
+    """ PnpFileManifest is a local JSON record of the files uploaded to one APIC-EM server, mapping
+        the md5 checksum of their content to the file id and name on the server.
+    """
+    def __init__(self, path, server):
+        self.path = path
+        self.server = server
+        self.updated = None
+        self.files = {'config': {}, 'image': {}}
+        self._checksums = {'config': {}, 'image': {}}
+        self._lock = threading.RLock()
+        if os.path.isfile(path):
+            try:
+                self._load()
+            except (ValueError, KeyError, TypeError, AttributeError):
+                # A corrupt or half written manifest is started over, empty and stale
+                print('Warning: Ignoring unreadable file manifest: ' + path)
+                self.updated = None
+                self.files = {'config': {}, 'image': {}}
+                self._checksums = {'config': {}, 'image': {}}
+
+    def _load(self):
+        with open(self.path) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get('server') == self.server:
+            for type in self.files:
+                for name, entry in manifest.get('files', {}).get(type, {}).items():
+                    self.add(type, name, entry['id'], entry['md5Checksum'])
+            self.updated = manifest.get('updated')
+
+    def is_fresh(self, max_age):
+        return self.updated is not None and time.time() - self.updated < max_age
+
+    def get_by_name(self, type, name):
+        return self.files[type].get(name)
+
+    def get_by_checksum(self, type, checksum):
+        return self._checksums[type].get(checksum)
+
+    def add(self, type, name, file_id, checksum):
+        with self._lock:
+            self.remove_name(type, name)
+            entry = {'id': file_id, 'name': name, 'md5Checksum': checksum}
+            self.files[type][name] = entry
+            self._checksums[type][checksum] = entry
+
+    def remove_name(self, type, name):
+        with self._lock:
+            entry = self.files[type].pop(name, None)
+            if entry is not None and self._checksums[type].get(entry['md5Checksum']) is entry:
+                del self._checksums[type][entry['md5Checksum']]
+
+    def remove_id(self, type, file_id):
+        with self._lock:
+            for name in [name for name, entry in self.files[type].items() if entry['id'] == file_id]:
+                self.remove_name(type, name)
+
+    def verify(self, type, index):
+        """ Drops the entries that no longer match a file in the namespace index of PnpFileHandler,
+            and marks the manifest as fresh
+        """
+        if index is None:
+            return
+        with self._lock:
+            for name, entry in list(self.files[type].items()):
+                file = index['id'].get(entry['id'])
+                if file is None or file.get('md5Checksum', entry['md5Checksum']) != entry['md5Checksum']:
+                    self.remove_name(type, name)
+            self.updated = time.time()
+
+    def save(self):
+        with self._lock:
+            if self.updated is None:
+                self.updated = time.time()
+            manifest = {'server': self.server, 'updated': self.updated, 'files': self.files}
+            # Written to a temporary file first so an interrupted save doesn't lose the manifest
+            with open(self.path + '.tmp', 'w') as manifest_file:
+                json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+            os.replace(self.path + '.tmp', self.path)
+
+
+class PnpStateCache:
+    """ PnpStateCache is a local sqlite copy of the projects, devices and file namespaces of one APIC-EM
+        server, so scripts don't have to download everything again on every run.
+
+        refresh() brings the whole cache up to date: the project list is read, and only the projects
+        whose deviceLastUpdate or deviceCount changed since they were cached have their devices read
+        again.  PnpProject and PnpFileHandler read through the cache when they are given one, and the
+        cached data can be queried without a connection to APIC-EM (projects, devices, count_devices_by).
+        The cache can be shared between threads.
+    """
+    def __init__(self, path, server=None):
+        self.path = path
+        self.server = server
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS projects (id TEXT PRIMARY KEY, siteName TEXT, '
+                             'deviceLastUpdate TEXT, deviceCount INTEGER, record TEXT, refreshed REAL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS devices (projectId TEXT, id TEXT, %s, record TEXT, '
+                             'PRIMARY KEY (projectId, id))' % ', '.join(field + ' TEXT' for field in CACHE_DEVICE_COLUMNS))
+            for field in CACHE_DEVICE_COLUMNS:
+                self._db.execute('CREATE INDEX IF NOT EXISTS devices_%s ON devices (%s)' % (field, field))
+            self._db.execute('CREATE TABLE IF NOT EXISTS files (type TEXT, id TEXT, name TEXT, record TEXT, '
+                             'PRIMARY KEY (type, id))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS namespaces (type TEXT PRIMARY KEY, refreshed REAL)')
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'server'").fetchone()
+            if server is not None and (row is None or row[0] != server):
+                # The cache belonged to another server (or is new), it starts over
+                for table in ('projects', 'devices', 'files', 'namespaces'):
+                    self._db.execute('DELETE FROM ' + table)
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('server', ?)", (server,))
+
+    def close(self):
+        self._db.close()
+
+    # Projects and devices
+    def is_current(self, value):
+        """ True if the cached devices of the project record value (from APIC-EM) are up to date
+        """
+        with self._lock:
+            row = self._db.execute('SELECT deviceLastUpdate, deviceCount FROM projects WHERE id = ?',
+                                   (value.get('id'),)).fetchone()
+        return row is not None and row == (_cache_text(value.get('deviceLastUpdate')), value.get('deviceCount'))
+
+    def store_project(self, value, device_records):
+        """ Replaces the cached project record value and its devices
+        """
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO projects VALUES (?, ?, ?, ?, ?, ?)',
+                             (value['id'], value.get('siteName'), _cache_text(value.get('deviceLastUpdate')),
+                              value.get('deviceCount'), json.dumps(value), time.time()))
+            self._db.execute('DELETE FROM devices WHERE projectId = ?', (value['id'],))
+            self._db.executemany('INSERT OR REPLACE INTO devices VALUES (?, ?, %s, ?)' % ', '.join('?' * len(CACHE_DEVICE_COLUMNS)),
+                                 ((value['id'], record.get('id')) +
+                                  tuple(_cache_text(record.get(field)) for field in CACHE_DEVICE_COLUMNS) +
+                                  (json.dumps(record),) for record in device_records))
+
+    def remove_project(self, id):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM projects WHERE id = ?', (id,))
+            self._db.execute('DELETE FROM devices WHERE projectId = ?', (id,))
+
+    def get_project(self, id):
+        with self._lock:
+            row = self._db.execute('SELECT record FROM projects WHERE id = ?', (id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_project_by_name(self, name):
+        with self._lock:
+            row = self._db.execute('SELECT record FROM projects WHERE siteName = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def projects(self):
+        with self._lock:
+            rows = self._db.execute('SELECT record FROM projects ORDER BY siteName').fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def devices(self, projectId=None, **criteria):
+        """ Returns the cached device records (of project projectId, or of every project) matching every
+            field=value in criteria, ex: cache.devices(state='ERROR', platformId='WS-C3650-48PQ')
+        """
+        where, values = self._device_filter(projectId, criteria)
+        with self._lock:
+            rows = self._db.execute('SELECT record FROM devices' + where, values).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def count_devices_by(self, field, projectId=None, **criteria):
+        """ Returns a dictionary of {value: number of devices} for field
+        """
+        where, values = self._device_filter(projectId, criteria)
+        with self._lock:
+            rows = self._db.execute('SELECT %s, COUNT(*) FROM devices%s GROUP BY 1' % (self._device_column(field), where),
+                                    values).fetchall()
+        return dict(rows)
+
+    def _device_column(self, field):
+        if field in CACHE_DEVICE_COLUMNS or field == 'projectId':
+            return field
+        if field not in _DEVICE_FIELD_SET:
+            raise ValueError('Unknown device field: ' + field)
+        return "json_extract(record, '$.%s')" % field
+
+    def _device_filter(self, projectId, criteria):
+        if projectId is not None:
+            criteria = dict(criteria, projectId=projectId)
+        if not criteria:
+            return '', ()
+        columns = []
+        values = []
+        for field, value in criteria.items():
+            column = self._device_column(field)
+            if field in CACHE_DEVICE_COLUMNS:
+                value = _cache_text(value)
+            columns.append(column + (' IS ?' if value is None else ' = ?'))
+            values.append(value)
+        return ' WHERE ' + ' AND '.join(columns), tuple(values)
+
+    def refresh(self, credentials, workers=DEFAULT_WORKERS, page_size=DEFAULT_PAGE_SIZE):
+        """ Brings the cached projects and devices up to date with APIC-EM.  Only the devices of the
+            projects that changed are read, up to workers projects at once.  Returns a dictionary of
+            lists of project ids: {'fetched', 'unchanged', 'removed', 'failed'}; the cache keeps the
+            previous devices of the projects that failed.  If the project listing itself can't be read
+            completely, no project is removed and listing_error is set to the reason (None otherwise).
+        """
+        result = {'fetched': [], 'unchanged': [], 'removed': [], 'failed': [], 'listing_error': None}
+
+        def read_devices(project):
+            if project.deviceCount == 0:
+                return []
+            return list(project.iter_device_details(page_size))
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = {}
+            values = {}
+            try:
+                for project in iter_projects(credentials, page_size):
+                    values[project.id] = dict((field, getattr(project, field)) for field in PROJECT_FIELDS
+                                              if getattr(project, field) is not None)
+                    if self.is_current(values[project.id]):
+                        result['unchanged'].append(project.id)
+                    else:
+                        futures[executor.submit(read_devices, project)] = project
+            except PnpListingError as e:
+                # The projects that were listed are still brought up to date
+                print('Error: ' + str(e))
+                result['listing_error'] = str(e)
+            for future in as_completed(futures):
+                project = futures[future]
+                try:
+                    records = future.result()
+                except Exception:
+                    traceback.print_exc()
+                    records = None
+                if records is None or (project.deviceCount and len(records) < project.deviceCount):
+                    result['failed'].append(project.id)
+                    continue
+                self.store_project(values[project.id], records)
+                result['fetched'].append(project.id)
+        finally:
+            executor.shutdown()
+
+        # A project missing from a complete listing was deleted.  An empty listing is more likely a
+        # failure than a server without projects, the cache is kept then
+        if values and result['listing_error'] is None:
+            for value in self.projects():
+                if value['id'] not in values:
+                    self.remove_project(value['id'])
+                    result['removed'].append(value['id'])
+        return result
+
+    # File namespaces
+    def store_files(self, type, records, refreshed=None):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM files WHERE type = ?', (type,))
+            self._db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                 ((type, record['id'], record.get('name'), json.dumps(record)) for record in records))
+            self._db.execute('INSERT OR REPLACE INTO namespaces VALUES (?, ?)', (type, refreshed or time.time()))
+
+    def add_file(self, type, record):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                             (type, record['id'], record.get('name'), json.dumps(record)))
+
+    def remove_file(self, type, id):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM files WHERE type = ? AND id = ?', (type, id))
+
+    def get_files(self, type):
+        """ Returns (the cached file records of the namespace, when they were downloaded), or
+            (None, None) if the namespace isn't cached
+        """
+        with self._lock:
+            row = self._db.execute('SELECT refreshed FROM namespaces WHERE type = ?', (type,)).fetchone()
+            if row is None:
+                return None, None
+            rows = self._db.execute('SELECT record FROM files WHERE type = ?', (type,)).fetchall()
+        return [json.loads(record[0]) for record in rows], row[0]
+
+
+def _cache_text(value):
+    # Indexed device columns are stored as text, whatever type APIC-EM used
+    return None if value is None else str(value)
+
+
+class _PnpFileHandlerBase:
+    """ The namespace index, uploads and deletes shared by PnpFileHandler and AsyncPnpFileHandler
+    """
+    def __init__(self, credentials, ttl=FILE_CACHE_TTL, negative_ttl=FILE_NEGATIVE_CACHE_TTL, manifest_path=None,
+                 manifest_max_age=MANIFEST_MAX_AGE, cache=None):
         self.credentials = credentials
+        self.client = get_client(credentials)
+        self.cache = cache
         self.files = {'config': None, 'image': None}
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._index = {'config': None, 'image': None}
+        self._misses = {'config': {}, 'image': {}}
+        self._lock = threading.RLock()
+        self.manifest = None
+        self.manifest_max_age = manifest_max_age
+        if manifest_path is not None:
+            self.manifest = PnpFileManifest(manifest_path, self.client.server)
 
 
     def refresh_file_list(self, type='config'):
         if type != 'config' and type != 'image':
             return None
         if type == 'config':
-            self.files[type] = make_rest_call(self.credentials, GET, '/api/v1/file/namespace/config')
+            self._set_file_list(type, make_rest_call(self.client, GET, '/api/v1/file/namespace/config'))
         elif type == 'image':
-            self.files[type] = make_rest_call(self.credentials, GET, '/api/v1/file/namespace/image')
+            self._set_file_list(type, make_rest_call(self.client, GET, '/api/v1/file/namespace/image'))
 
 
     def get_file_id_by_name(self, file_name, type='config'):
-        if type != 'config' and type != 'image':
-            return None
-        if self.files[type] is None:
-            self.refresh_file_list(type)
-        for file in self.files[type]['response']:
-            if file['name'] == file_name:
-                return file['id']
-
-        # If no hits update files and try again
-        self.refresh_file_list(type)
-        for file in self.files[type]['response']:
-            if file['name'] == file_name:
-                return file['id']
-
-        # If no hists after update, return None
+        file = self._lookup_file('name', file_name, type)
+        if file is not None:
+            return file['id']
         return None
 
 
     def get_file_name_by_id(self, id, type='config'):
-        if type != 'config' and type != 'image':
-            return None
-        if self.files[type] is None:
-            self.refresh_file_list(type)
-        for file in self.files[type]['response']:
-            if file['id'] == id:
-                return file['name']
+        file = self._lookup_file('id', id, type)
+        if file is not None:
+            return file['name']
+        return None
 
-        # If no hits update files and try again
-        self.refresh_file_list(type)
-        for file in self.files[type]['response']:
-            if file['id'] == id:
-                return file['name']
 
-        # If no hists after update, return None
+    def get_file_id_by_checksum(self, checksum, type='config', algorithm='md5'):
+        """ Returns the id of a file with the given md5 (or sha1) checksum, whatever its name is
+        """
+        file = self._lookup_file(algorithm + 'Checksum', checksum, type)
+        if file is not None:
+            return file['id']
         return None
 
 
-    def upload_file(self, path, type='config'):
+    def _lookup_file(self, key, value, type):
+        if type != 'config' and type != 'image':
+            return None
+        file, refresh = self._find_file(key, value, type)
+        if refresh and self._index[type] is None and self._load_cached_file_list(type):
+            file, refresh = self._find_file(key, value, type)
+        if refresh:
+            self.refresh_file_list(type)
+            file, refresh = self._find_file(key, value, type)
+        if file is None:
+            self._add_miss(key, value, type)
+        return file
+
+    def _load_cached_file_list(self, type):
+        if self.cache is None:
+            return False
+        records, refreshed = self.cache.get_files(type)
+        if records is None or time.time() - refreshed > self.ttl:
+            return False
+        self._set_file_list(type, {'response': records}, refreshed)
+        return True
+
+    def _set_file_list(self, type, response, refreshed=None):
+        """ Rebuilds the index of a namespace from a file/namespace response, downloaded at refreshed
+            (now by default, in which case it is also cached)
+        """
+        if not response or 'errorCode' in response['response']:
+            return
+        if refreshed is None:
+            refreshed = time.time()
+            if self.cache is not None:
+                self.cache.store_files(type, response['response'], refreshed)
+        index = dict((key, {}) for key in FILE_INDEX_KEYS)
+        index['refreshed'] = refreshed
+        for file in response['response']:
+            for key in FILE_INDEX_KEYS:
+                if file.get(key) is not None:
+                    index[key][file[key]] = file
+        with self._lock:
+            self.files[type] = response
+            self._index[type] = index
+            self._misses[type] = {}
+
+    def _find_file(self, key, value, type):
+        """ Looks a file up in the index without going to APIC-EM.
+            Returns (file or None, True if the namespace should be downloaded again)
+        """
+        now = time.time()
+        with self._lock:
+            index = self._index[type]
+            if index is None or now - index['refreshed'] > self.ttl:
+                return None, True
+            if value in index[key]:
+                return index[key][value], False
+            if self._misses[type].get((key, value), 0) > now:
+                return None, False
+            return None, now - index['refreshed'] > self.negative_ttl
+
+    def _add_miss(self, key, value, type):
+        with self._lock:
+            if self._misses[type].get((key, value), 0) <= time.time():
+                self._misses[type][(key, value)] = time.time() + self.negative_ttl
+
+    def _add_file(self, type, file):
+        with self._lock:
+            index = self._index[type]
+            for key in FILE_INDEX_KEYS:
+                if file.get(key) is not None:
+                    if index is not None:
+                        index[key][file[key]] = file
+                    self._misses[type].pop((key, file[key]), None)
+            if index is not None:
+                self.files[type]['response'].append(file)
+        if self.cache is not None:
+            self.cache.add_file(type, file)
+
+    def _remove_file(self, type, file_id):
+        with self._lock:
+            index = self._index[type]
+            if index is not None and file_id in index['id']:
+                file = index['id'][file_id]
+                for key in FILE_INDEX_KEYS:
+                    if file.get(key) is not None and index[key].get(file[key]) is file:
+                        del index[key][file[key]]
+                self.files[type]['response'] = [f for f in self.files[type]['response'] if f['id'] != file_id]
+        if self.cache is not None:
+            self.cache.remove_file(type, file_id)
+
+
+    def upload_file(self, path, type='config', callback=None, dedupe=True):
+        """ Uploads a file and returns its id.  The file is streamed from disk, so large images are
+            never held in memory, and callback(bytes_sent, total_bytes) is called as it is sent.
+            With dedupe, the checksum of the file is computed first and if APIC-EM already has a file
+            with the same checksum (under any name) its id is returned without uploading.
+        """
         if type != 'config' and type != 'image':
             return None
         if not os.path.isfile(path):
             return None
-        
-        open_file = open(path, 'rb')
-        if (open_file.name[-3:] == 'txt') or type == 'image':
-            file = {'file': open(path, 'rb')}
-        else:
-            file = {'file': (os.path.basename(open_file.name) + '.txt', open(path, 'rb'))}
-        response = make_rest_call(self.credentials, POST, '/api/v1/file/'+type, files=file)
-        return response['response']['id']
 
-    def delete_file(self, file_id, type='config'):
+        file_name = _upload_name(os.path.basename(path), type)
+
+        if dedupe:
+            file_id = self.get_file_id_by_checksum(file_checksum(path), type)
+            if file_id is not None:
+                return file_id
+
+        stream = MultipartFileStream(path, file_name, callback=callback)
+        try:
+            response = make_rest_call(self.client, POST, '/api/v1/file/'+type, stream=stream)
+        finally:
+            stream.close()
+        if not response or 'id' not in response['response']:
+            return None
+
+        uploaded = dict(response['response'])
+        uploaded.setdefault('name', file_name)
+        uploaded.setdefault('md5Checksum', stream.md5.hexdigest())
+        if uploaded['md5Checksum'] != stream.md5.hexdigest():
+            print('Warning: Checksum of uploaded file does not match: ' + path)
+        self._add_file(type, uploaded)
+        if self.manifest is not None:
+            self.manifest.add(type, uploaded['name'], uploaded['id'], stream.md5.hexdigest())
+        return uploaded['id']
+
+    def delete_file(self, file_id, type='config', check=True):
+        """ Deletes a file.  Unless check is False, the file is first looked up in the namespace
+        """
         if type != 'config' and type != 'image':
             return None
-        if self.get_file_name_by_id(file_id, type):
-            response = make_rest_call(self.credentials, DELETE, '/api/v1/pnp-file/'+type+'/'+file_id)
-            task_status = get_task_id(self.credentials, response['response']['taskId'])
+        if not check or self.get_file_name_by_id(file_id, type):
+            response = make_rest_call(self.client, DELETE, '/api/v1/pnp-file/'+type+'/'+file_id)
+            if not response or 'taskId' not in response['response']:
+                return None
+            task_status = get_task_id(self.client, response['response']['taskId'])
             if (task_status['isError']):
                 return None
             else:
+                self._remove_file(type, file_id)
+                if self.manifest is not None:
+                    self.manifest.remove_id(type, file_id)
                 return True
 
 
-class PnpProject:
-    def __init__(self, credentials):
+    def delete_files(self, file_ids, type='config', deadline=TASK_DEADLINE):
+        """ Deletes several files at once, the delete tasks are waited on together.
+            Returns a dictionary of file_id: True (or None if the file couldn't be deleted)
+        """
+        if type != 'config' and type != 'image':
+            return None
+        results = {}
+        tasks = {}
+        for file_id in file_ids:
+            results[file_id] = None
+            if self.get_file_name_by_id(file_id, type):
+                response = make_rest_call(self.client, DELETE, '/api/v1/pnp-file/'+type+'/'+file_id)
+                if response and 'taskId' in response['response']:
+                    tasks[response['response']['taskId']] = file_id
+
+        for task_id, task_status in TaskWaiter(self.client, deadline).as_completed(tasks):
+            if not task_status['isError']:
+                self._remove_file(type, tasks[task_id])
+                if self.manifest is not None:
+                    self.manifest.remove_id(type, tasks[task_id])
+                results[tasks[task_id]] = True
+        return results
+
+
+class PnpFileHandler(_PnpFileHandlerBase):
+    """ PnpFileHandler keeps a name and id index of the config and image namespaces.  An index is
+        downloaded again once it is older than ttl seconds.  A lookup that misses re-downloads the
+        namespace at most once every negative_ttl seconds, and the miss itself is remembered for
+        negative_ttl seconds.  Uploads and deletes made through the handler update the index locally.
+
+        With manifest_path, the handler also keeps a local manifest of the files it uploaded (see
+        PnpFileManifest and sync_directory).  With a PnpStateCache, a namespace downloaded less than
+        ttl seconds ago (by this or an earlier run) is read from the cache instead of APIC-EM.
+    """
+    def sync_directory(self, path, type='config', workers=DEFAULT_WORKERS):
+        """ Makes sure every file in the directory path is on APIC-EM and returns a dictionary of
+            {file name: file id (or None if it couldn't be uploaded)}.
+
+            The files are hashed in parallel and compared against the manifest (manifest_path is
+            required), so only new or changed files are uploaded.  A changed file is deleted and
+            uploaded again.  While the manifest is younger than manifest_max_age seconds the file
+            namespace is never downloaded, once it is older the manifest is checked against the
+            namespace (one download) before it is trusted again.
+        """
+        if type != 'config' and type != 'image':
+            return None
+        if self.manifest is None:
+            print('Error: sync_directory requires a manifest_path')
+            return None
+
+        files = [file for file in sorted(os.listdir(path))
+                 if not file.startswith('.') and os.path.isfile(os.path.join(path, file))]
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            checksums = dict(zip(files, executor.map(lambda file: file_checksum(os.path.join(path, file)), files)))
+
+            fresh = self.manifest.is_fresh(self.manifest_max_age)
+            if not fresh:
+                self.refresh_file_list(type)
+                self.manifest.verify(type, self._index[type])
+
+            results = {}
+            changed = []
+            for file in files:
+                entry = self.manifest.get_by_checksum(type, checksums[file])
+                if entry is not None:
+                    results[file] = entry['id']
+                else:
+                    changed.append(file)
+
+            def upload(file):
+                name = _upload_name(file, type)
+                old_file = self.manifest.get_by_name(type, name)
+                if old_file is None and not fresh:
+                    old_file = self._find_file('name', name, type)[0]
+                # The content changed, so the old file is replaced
+                if old_file is not None and old_file.get('md5Checksum') != checksums[file]:
+                    self.delete_file(old_file['id'], type, check=False)
+                file_id = self.upload_file(os.path.join(path, file), type, dedupe=not fresh)
+                if file_id is not None:
+                    self.manifest.add(type, name, file_id, checksums[file])
+                return file_id
+
+            for file, file_id in zip(changed, executor.map(upload, changed)):
+                results[file] = file_id
+        finally:
+            executor.shutdown()
+
+        self.manifest.save()
+        return results
+
+
+def update_projects(projects, deadline=TASK_DEADLINE):
+    """ Pushes the local changes of several PnpProject objects (see update_project) at once, the
+        update tasks are waited on together.  Returns the list of project ids (None for projects
+        that failed to update, with error and error_reason set on the project)
+    """
+    tasks = {}
+    for project in projects:
+        response = make_rest_call(project.client, PUT, '/api/v1/pnp-project', [project.create_project_parameters()])
+        if not response or 'taskId' not in response['response']:
+            project.error = True
+            project.error_reason = 'Unable to update project'
+        else:
+            tasks[response['response']['taskId']] = project
+
+    waiters = {}
+    for task_id, project in tasks.items():
+        if project.client not in waiters:
+            waiters[project.client] = TaskWaiter(project.client, deadline)
+    futures = dict((task_id, waiters[project.client].submit(task_id)) for task_id, project in tasks.items())
+    updated = set()
+    for task_id, project in tasks.items():
+        task_status = futures[task_id].result()
+        if (task_status['isError']):
+            project.error = True
+            project.error_reason = task_status['failureReason']
+        else:
+            project.get_project_by_id(project.id, False)
+            updated.add(project.id)
+
+    return [project.id if project.id in updated else None for project in projects]
+
+
+def watch_projects(projects, callback=None, interval=WATCH_INTERVAL, max_interval=WATCH_MAX_INTERVAL,
+                   backoff=WATCH_BACKOFF, timeout=None, stop=None, workers=DEFAULT_WORKERS):
+    """ Watches the devices of several projects for state changes, see PnpProject.watch.  Each project
+        is polled on its own adaptive interval, and at most workers projects are polled at once.
+    """
+    watches = [{'project': project, 'interval': interval, 'next_poll': 0, 'marker': None, 'devices': None}
+               for project in projects]
+    # The devices are read once right away, changes are reported from this point on even if the
+    # generator is only consumed later
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(_poll_watch, watches))
+    for watch in watches:
+        watch['next_poll'] = time.time() + interval
+    events = _watch_events(watches, interval, max_interval, backoff, timeout, stop, workers)
+    if callback is None:
+        return events
+    for event in events:
+        callback(event)
+
+
+def _watch_events(watches, interval, max_interval, backoff, timeout, stop, workers):
+    end_time = None if timeout is None else time.time() + timeout
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            now = time.time()
+            due = [watch for watch in watches if watch['next_poll'] <= now]
+            for watch, events in zip(due, executor.map(_poll_watch, due)):
+                if events:
+                    watch['interval'] = interval
+                else:
+                    watch['interval'] = min(watch['interval'] * backoff, max_interval)
+                watch['next_poll'] = time.time() + watch['interval']
+                for event in events:
+                    yield event
+
+            now = time.time()
+            if (stop is not None and stop.is_set()) or (end_time is not None and now >= end_time):
+                return
+            wait = min(watch['next_poll'] for watch in watches) - now
+            if end_time is not None:
+                wait = min(wait, end_time - now)
+            if stop is not None:
+                stop.wait(max(wait, 0))
+            elif wait > 0:
+                time.sleep(wait)
+    finally:
+        executor.shutdown(wait=False)
+
+
+def _poll_watch(watch):
+    """ Polls one watched project.  The devices are only listed when deviceLastUpdate,
+        pendingDeviceCount or deviceCount changed, and only the devices whose
+        lastStateTransitionTime or state changed become events
+    """
+    project = watch['project']
+    response = make_rest_call(project.client, GET, '/api/v1/pnp-project/' + project.id)
+    if not response:
+        return []
+    value = response['response']
+    if 'errorCode' in value:
+        print('Error: Unable to get Project: ' + value['message'] + ' (' + value['detail'] + ')')
+        return []
+    project.populate_project(value)
+    marker = (value.get('deviceLastUpdate'), value.get('pendingDeviceCount'), value.get('deviceCount'))
+    if marker == watch['marker']:
+        return []
+
+    events = []
+    old_devices = watch['devices']
+    devices = {}
+    complete = True
+    try:
+        for deviceDetail in project.iter_device_details():
+            version = (deviceDetail.get('lastStateTransitionTime'), deviceDetail.get('state'), deviceDetail.get('hostName'))
+            devices[deviceDetail.get('id')] = version
+            if old_devices is None:
+                continue
+            old_version = old_devices.get(deviceDetail.get('id'))
+            if old_version is None or old_version[:2] != version[:2]:
+                events.append(_watch_event(project, deviceDetail, old_version[1] if old_version else None,
+                                           version[1], 'changed' if old_version else 'added'))
+    except PnpListingError as e:
+        print('Error: ' + str(e))
+        complete = False
+
+    if not complete or (value.get('deviceCount') is not None and len(devices) < value['deviceCount']):
+        # The listing was cut short, the project is listed again on the next poll
+        if old_devices is not None:
+            old_devices.update(devices)
+        return events
+    if old_devices is not None:
+        for id, old_version in old_devices.items():
+            if id not in devices:
+                events.append(_watch_event(project, {'id': id, 'state': old_version[1], 'hostName': old_version[2]},
+                                           old_version[1], None, 'removed'))
+    watch['marker'] = marker
+    watch['devices'] = devices
+    return events
+
+
+def _watch_event(project, deviceDetail, old_state, new_state, type):
+    device = PnpDevice()
+    device.projectId = project.id
+    device.populate_device(deviceDetail)
+    return {'type': type, 'project': project, 'device': device, 'old_state': old_state, 'new_state': new_state,
+            'error': new_state in DEVICE_ERROR_STATES}
+
+
+def _device_key(device_parameters):
+    """ Devices are matched by hostName, falling back to serialNumber
+    """
+    if device_parameters.get('hostName') is not None:
+        return ('hostName', device_parameters['hostName'])
+    if device_parameters.get('serialNumber') is not None:
+        return ('serialNumber', device_parameters['serialNumber'])
+    return None
+
+
+def _resolve_file_names(device_parameters, file_handler, file_ids=None):
+    """ Returns a copy of device_parameters with configName and imageName replaced by configId and
+        imageId, looked up in file_ids ({type: {name: id}}) and then through file_handler
+    """
+    device_parameters = dict(device_parameters)
+    for name_field, (id_field, type) in DEVICE_FILE_FIELDS.items():
+        if name_field in device_parameters:
+            name = device_parameters.pop(name_field)
+            file_id = None
+            if file_ids is not None:
+                file_id = file_ids[type].get(name)
+            if file_id is None:
+                file_id = file_handler.get_file_id_by_name(name, type)
+            device_parameters[id_field] = file_id
+    return device_parameters
+
+
+def _manifest_format(path, format=None):
+    if format is not None:
+        return format
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+def iter_manifest(path, format=None):
+    """ Generator of the rows of a device manifest as (line number, row dictionary), read one at a time.
+        The manifest is CSV with a header line (path ending with .csv, or format='csv') or JSONL, a
+        JSON object per line.  Rows that can't be parsed are yielded as None
+    """
+    with open(path, newline='') as manifest:
+        if _manifest_format(path, format) == 'csv':
+            reader = csv.DictReader(manifest)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for line, text in enumerate(manifest, 1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError:
+                row = None
+            yield line, row if isinstance(row, dict) else None
+
+
+def _manifest_device_parameters(row, file_handler):
+    """ Returns (device_parameters, None) for a valid manifest row, or (None, error_reason)
+    """
+    if row is None:
+        return None, 'Unable to parse row'
+    device_parameters = {}
+    for field, value in row.items():
+        if field is None:
+            return None, 'More values than columns'
+        field = MANIFEST_ALIASES.get(field.strip(), field.strip())
+        if isinstance(value, str):
+            value = value.strip()
+            # CSV has no booleans
+            if value.lower() in ('true', 'false'):
+                value = value.lower() == 'true'
+        if value is None or value == '':
+            continue
+        if field not in _DEVICE_FIELD_SET and field not in DEVICE_FILE_FIELDS:
+            return None, 'Unknown field: ' + field
+        device_parameters[field] = value
+    if _device_key(device_parameters) is None:
+        return None, 'hostName or serialNumber is required'
+
+    resolved = _resolve_file_names(device_parameters, file_handler)
+    for name_field, (id_field, type) in DEVICE_FILE_FIELDS.items():
+        if name_field in device_parameters and resolved[id_field] is None:
+            return None, 'Unable to locate ' + type + ' file: ' + str(device_parameters[name_field])
+    return resolved, None
+
+
+class DeviceIndex(MutableMapping):
+    """ DeviceIndex holds the PnpDevice objects of a project (PnpProject.device_list) and indexes them
+        by id, serialNumber and hostName, and groups them by state and platformId, so every lookup is
+        a dictionary access instead of a scan of the project.
+
+        It is also a dictionary of the devices keyed by hostName, as device_list always was.  Devices
+        without a hostName are keyed by serialNumber (or id) instead of overwriting each other, and the
+        key of device_list[key] = device is taken from the device.  A device whose fields were changed
+        is indexed again with add(device); adding a device with the id of another one replaces it.
+
+        Devices added or updated by this library are built from the parameters that were sent, so
+        their state (and any field APIC-EM fills in) is None, and they are grouped under None until
+        the project is read again with get_project_by_id.
+    """
+    GROUP_FIELDS = ('state', 'platformId')
+
+    def __init__(self, devices=()):
+        self._entries = {}
+        self._by_key = {}
+        self._by_id = {}
+        self._by_serial = {}
+        self._by_name = {}
+        self._groups = dict((field, {}) for field in self.GROUP_FIELDS)
+        self._lock = threading.RLock()
+        for device in devices:
+            self.add(device)
+
+    @staticmethod
+    def key(device):
+        if device.hostName is not None:
+            return device.hostName
+        if device.serialNumber is not None:
+            return device.serialNumber
+        return device.id
+
+    def add(self, device):
+        with self._lock:
+            self._unindex(device)
+            key = self.key(device)
+            for replaced in (self._by_id.get(device.id), self._by_key.get(key)):
+                if replaced is not None:
+                    self._unindex(replaced)
+            values = (key, device.id, device.serialNumber, device.hostName) + \
+                tuple(getattr(device, field) for field in self.GROUP_FIELDS)
+            self._entries[id(device)] = (device, values)
+            for index, value in zip((self._by_key, self._by_id, self._by_serial, self._by_name), values):
+                if value is not None:
+                    index[value] = device
+            for field, value in zip(self.GROUP_FIELDS, values[4:]):
+                self._groups[field].setdefault(value, {})[id(device)] = device
+        return device
+
+    def remove(self, device):
+        """ Removes the device (or the device with its id) from the index
+        """
+        with self._lock:
+            if id(device) not in self._entries:
+                device = self._by_id.get(device.id)
+            if device is not None:
+                self._unindex(device)
+
+    def _unindex(self, device):
+        entry = self._entries.pop(id(device), None)
+        if entry is None:
+            return
+        values = entry[1]
+        for index, value in zip((self._by_key, self._by_id, self._by_serial, self._by_name), values):
+            if value is not None and index.get(value) is device:
+                del index[value]
+        for field, value in zip(self.GROUP_FIELDS, values[4:]):
+            group = self._groups[field][value]
+            del group[id(device)]
+            if not group:
+                del self._groups[field][value]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for index in (self._by_key, self._by_id, self._by_serial, self._by_name):
+                index.clear()
+            for field in self.GROUP_FIELDS:
+                self._groups[field].clear()
+
+    def get_by_id(self, id):
+        return self._by_id.get(id)
+
+    def get_by_serial(self, serial_number):
+        return self._by_serial.get(serial_number)
+
+    def get_by_name(self, host_name):
+        return self._by_name.get(host_name)
+
+    def with_state(self, state):
+        return list(self._groups['state'].get(state, {}).values())
+
+    def with_platform(self, platform_id):
+        return list(self._groups['platformId'].get(platform_id, {}).values())
+
+    def count_by(self, field):
+        """ Returns a dictionary of {value: number of devices} for state or platformId
+        """
+        return dict((value, len(group)) for value, group in self._groups[field].items())
+
+    # Dictionary of the devices by hostName
+    def __getitem__(self, key):
+        return self._by_key[key]
+
+    def __setitem__(self, key, device):
+        self.add(device)
+
+    def __delitem__(self, key):
+        self.remove(self._by_key[key])
+
+    def __iter__(self):
+        return iter(list(self._by_key))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._by_key
+
+
+class _PnpProjectBase:
+    """ The project and device operations shared by PnpProject and AsyncPnpProject.  sync, watch and
+        import_manifest run their work on threads with blocking calls, so they are only on PnpProject
+    """
+    def __init__(self, credentials, cache=None):
         self.error = False
         self.error_reason = ''
-        self.device_list = {}
+        self.device_list = DeviceIndex()
         self.credentials = credentials
+        self.client = get_client(credentials)
+        self.cache = cache
         #APIC-EM PnP Project Attribues:
-        self.id = None
-        self.state = None
-        self.provisionedBy = None
-        self.provisionedOn = None
-        self.siteName = None
-        self.tftpServer = None
-        self.tftpPath = None
-        self.note = None
-        self.deviceCount = None
-        self.pendingDeviceCount = None
-        self.deviceLastUpdate = None
-        self.installerUserID = None
+        for field in PROJECT_FIELDS:
+            setattr(self, field, None)
 
 
     def create_project(self, project_parameters=None):
@@ -235,8 +2045,13 @@ class PnpProject:
         if project_parameters is None:
             project_parameters = self.create_project_parameters()
 
-        response = make_rest_call(self.credentials, POST, '/api/v1/pnp-project', [project_parameters])
-        task_status = get_task_id(self.credentials, response['response']['taskId'])
+        response = make_rest_call(self.client, POST, '/api/v1/pnp-project', [project_parameters])
+        if not response or 'taskId' not in response['response']:
+            self.id = None
+            self.error = True
+            self.error_reason = 'Unable to create project'
+            return None
+        task_status = get_task_id(self.client, response['response']['taskId'])
 
         if (task_status['isError']):
             self.id = None
@@ -251,27 +2066,18 @@ class PnpProject:
                 return self.id
 
     def create_project_parameters(self):
-        project_parameters = {}
-        if self.id is not None: project_parameters['id'] = self.id
-        if self.state is not None: project_parameters['state'] = self.state
-        if self.provisionedBy is not None: project_parameters['provisionedBy'] = self.provisionedBy
-        if self.provisionedOn is not None: project_parameters['provisionedOn'] = self.provisionedOn
-        if self.siteName is not None: project_parameters['siteName'] = self.siteName
-        if self.tftpServer is not None: project_parameters['tftpServer'] = self.tftpServer
-        if self.tftpPath is not None: project_parameters['tftpPath'] = self.tftpPath
-        if self.note is not None: project_parameters['note'] = self.note
-        if self.deviceCount is not None: project_parameters['deviceCount'] = self.deviceCount
-        if self.pendingDeviceCount is not None: project_parameters['pendingDeviceCount'] = self.pendingDeviceCount
-        if self.deviceLastUpdate is not None: project_parameters['deviceLastUpdate'] = self.deviceLastUpdate
-        if self.installerUserID is not None: project_parameters['installerUserID'] = self.installerUserID
-        return project_parameters
+        return {field: value for field, value in zip(PROJECT_FIELDS, _project_values(self)) if value is not None}
 
     def update_project(self, project_parameters=None):
         if project_parameters is None:
             project_parameters = self.create_project_parameters()
 
-        response = make_rest_call(self.credentials, PUT, '/api/v1/pnp-project', [project_parameters])
-        task_status = get_task_id(self.credentials, response['response']['taskId'])
+        response = make_rest_call(self.client, PUT, '/api/v1/pnp-project', [project_parameters])
+        if not response or 'taskId' not in response['response']:
+            self.error = True
+            self.error_reason = 'Unable to update project'
+            return None
+        task_status = get_task_id(self.client, response['response']['taskId'])
 
         if (task_status['isError']):
             self.id = None
@@ -285,115 +2091,610 @@ class PnpProject:
     def add_device(self, device):
         device.create_device(self)
         if device.error:
-            print('Error Adding Device to Project: ' + device.error_reason + '(Device Name: ' + device.hostName + ')')
-        else:
-            self.device_list[device.hostName] = device
-            self.get_project_by_id(self.id, False)
+            print('Error Adding Device to Project: ' + device.error_reason + '(Device Name: ' + str(device.hostName) + ')')
+            return None
+        self.device_list.add(device)
+        self.get_project_by_id(self.id, False)
+        return device
 
     def add_device_with_parameters(self, device_parameters):
         device = PnpDevice()
         device.create_device(self, device_parameters)
         if device.error:
-            print('Error Adding Device to Project: ' + device.error_reason + '(Device Name: ' + device_parameters['hostName'] + ')')
-        else:
-            self.device_list[device.hostName] = device
-            self.get_project_by_id(self.id, False)
+            print('Error Adding Device to Project: ' + device.error_reason + '(Device Name: ' + str(device_parameters.get('hostName')) + ')')
+            return None
+        self.device_list.add(device)
+        self.get_project_by_id(self.id, False)
+        return device
+
+    def add_devices(self, devices, chunk_size=DEFAULT_CHUNK_SIZE, deadline=TASK_DEADLINE, keep=True):
+        """ Bulk version of add_device/add_device_with_parameters.  devices is a list of PnpDevice
+            objects and/or device_parameters dictionaries.  Devices are sent chunk_size at a time, with
+            one POST per chunk, the chunk tasks are waited on together, and the project is refreshed
+            once at the end.  With keep=False the added devices are not kept in device_list.  When a
+            chunk fails, its devices are sent again one at a time, so only the devices that caused the
+            error fail.
+
+            Returns a list of PnpDevice objects in the same order as devices.  Devices that could not
+            be added have error set to True and error_reason set.
+        """
+        pending = []
+        for item in devices:
+            if isinstance(item, PnpDevice):
+                pending.append((item, item.create_device_parameters()))
+            else:
+                device = PnpDevice()
+                device.populate_device(item)
+                pending.append((device, item))
+
+        # Send every chunk first and then wait on all of the chunk tasks together
+        waiter = TaskWaiter(self.client, deadline)
+        chunks = [pending[start:start + chunk_size] for start in range(0, len(pending), chunk_size)]
+        unresolved = []
+        while chunks:
+            tasks = {}
+            for chunk in chunks:
+                response = make_rest_call(self.client, POST, '/api/v1/pnp-project/' + self.id + '/device',
+                                          [device_parameters for device, device_parameters in chunk])
+                if not response or 'taskId' not in response['response']:
+                    for device, device_parameters in chunk:
+                        self._device_failed(device, device_parameters, 'Unable to create devices')
+                else:
+                    tasks[response['response']['taskId']] = chunk
+
+            chunks = []
+            for task_id, task_status in waiter.as_completed(tasks):
+                chunk = tasks[task_id]
+                if task_status['isError'] and len(chunk) > 1:
+                    chunks.extend([item] for item in chunk)
+                    continue
+                if task_status['isError']:
+                    device, device_parameters = chunk[0]
+                    self._device_failed(device, device_parameters, task_status['failureReason'])
+                    continue
+
+                rule_ids = get_task_rule_ids(task_status)
+                if len(rule_ids) == len(chunk):
+                    for (device, device_parameters), rule_id in zip(chunk, rule_ids):
+                        self._device_added(device, device_parameters, rule_id, keep)
+                else:
+                    # The task didn't report one ruleId per device, look the devices up in the project below
+                    unresolved.extend(chunk)
+
+        if unresolved:
+            existing = {}
+            try:
+                for deviceDetail in self.iter_device_details():
+                    existing[_device_key(deviceDetail)] = deviceDetail
+            except PnpListingError as e:
+                # The devices that weren't listed are reported as failed below
+                print('Error: ' + str(e))
+            for device, device_parameters in unresolved:
+                key = _device_key(device_parameters)
+                if key is not None and key in existing:
+                    self._device_added(device, existing[key], existing[key]['id'], keep)
+                else:
+                    self._device_failed(device, device_parameters, 'Unable to locate device after adding it to Project')
+
+        self.get_project_by_id(self.id, False)
+        return [device for device, device_parameters in pending]
+
+    def _device_added(self, device, device_parameters, rule_id, keep=True):
+        device.populate_device(device_parameters)
+        device.id = rule_id
+        device.projectId = self.id
+        device.error = False
+        device.error_reason = ''
+        if keep:
+            self.device_list.add(device)
+
+    def _device_failed(self, device, device_parameters, failure_reason, message='Error Adding Device to Project: '):
+        device.error = True
+        device.error_reason = failure_reason
+        print(message + failure_reason + '(Device Name: ' + str(device_parameters.get('hostName')) + ')')
+
+    def update_devices(self, devices, chunk_size=DEFAULT_CHUNK_SIZE, deadline=TASK_DEADLINE):
+        """ Bulk version of update_device.  devices is a list of PnpDevice objects (their local
+            changes are pushed) and/or device_parameters dictionaries with the id of the device and the
+            fields to change, ex: {'id': device.id, 'imageId': image_id}.  A dictionary is merged into the
+            device in device_list with that id.  Devices are sent chunk_size at a time, with one PUT per
+            chunk, and the chunk tasks are waited on together.  When a chunk fails, its devices are sent
+            again one at a time so the error is reported on the devices that caused it.
+
+            Returns a list of PnpDevice objects in the same order as devices.  Devices that could not
+            be updated have error set to True and error_reason set.
+        """
+        pending = []
+        for item in devices:
+            if isinstance(item, PnpDevice):
+                pending.append((item, item.create_device_parameters()))
+                continue
+            device = self.device_list.get_by_id(item.get('id'))
+            if device is None:
+                device = PnpDevice()
+                device_parameters = dict(item)
+            else:
+                device_parameters = device.create_device_parameters()
+                device_parameters.update(item)
+            pending.append((device, device_parameters))
+
+        waiter = TaskWaiter(self.client, deadline)
+        chunks = [pending[start:start + chunk_size] for start in range(0, len(pending), chunk_size)]
+        while chunks:
+            tasks = {}
+            for chunk in chunks:
+                response = make_rest_call(self.client, PUT, '/api/v1/pnp-project/' + self.id + '/device',
+                                          [device_parameters for device, device_parameters in chunk])
+                if not response or 'taskId' not in response['response']:
+                    for device, device_parameters in chunk:
+                        self._device_failed(device, device_parameters, 'Unable to update device',
+                                            'Error Updating Device: ')
+                else:
+                    tasks[response['response']['taskId']] = chunk
+
+            chunks = []
+            for task_id, task_status in waiter.as_completed(tasks):
+                chunk = tasks[task_id]
+                if task_status['isError'] and len(chunk) > 1:
+                    chunks.extend([item] for item in chunk)
+                elif task_status['isError']:
+                    device, device_parameters = chunk[0]
+                    self._device_failed(device, device_parameters, task_status['failureReason'],
+                                        'Error Updating Device: ')
+                else:
+                    for device, device_parameters in chunk:
+                        device.populate_device(device_parameters)
+                        device.projectId = self.id
+                        device.error = False
+                        device.error_reason = ''
+                        self.device_list.add(device)
+
+        self.get_project_by_id(self.id, False)
+        return [device for device, device_parameters in pending]
+
+    def delete_devices(self, devices, workers=DEFAULT_WORKERS, deadline=TASK_DEADLINE):
+        """ Bulk version of delete_device.  devices is a list of PnpDevice objects and/or device ids.
+            APIC-EM deletes one device per request, so up to workers DELETEs are sent at once, and their
+            tasks are waited on together.  The deleted devices are removed from device_list.
+
+            Returns a list of PnpDevice objects in the same order as devices.  Devices that could not
+            be deleted have error set to True and error_reason set.
+        """
+        pending = []
+        for item in devices:
+            if not isinstance(item, PnpDevice):
+                device = self.device_list.get_by_id(item)
+                if device is None:
+                    device = PnpDevice()
+                    device.id = item
+                item = device
+            pending.append(item)
+
+        def send(device):
+            return make_rest_call(self.client, DELETE, '/api/v1/pnp-project/' + self.id + '/device/' + device.id)
+
+        sendable = []
+        for device in pending:
+            if device.id is None:
+                self._device_failed(device, {'hostName': device.hostName}, 'Device has no id', 'Error Deleting Device: ')
+            else:
+                sendable.append(device)
+
+        tasks = {}
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for device, response in zip(sendable, executor.map(send, sendable)):
+                if not response or 'taskId' not in response['response']:
+                    self._device_failed(device, {'hostName': device.hostName}, 'Unable to delete device',
+                                        'Error Deleting Device: ')
+                else:
+                    tasks[response['response']['taskId']] = device
+        finally:
+            executor.shutdown()
+
+        for task_id, task_status in TaskWaiter(self.client, deadline).as_completed(tasks):
+            device = tasks[task_id]
+            if task_status['isError']:
+                self._device_failed(device, {'hostName': device.hostName}, task_status['failureReason'],
+                                    'Error Deleting Device: ')
+            else:
+                device.error = False
+                device.error_reason = ''
+                self.device_list.remove(device)
+
+        self.get_project_by_id(self.id, False)
+        return pending
+
+    def get_device_details(self):
+        """ Returns the raw device records of the project from APIC-EM, raises PnpListingError if
+            they can't all be read
+        """
+        return list(self.iter_device_details())
+
+    def find_device_detail(self, device_parameters):
+        """ Returns the raw device record matching device_parameters by hostName (or serialNumber),
+            reading the device list only until it is found
+        """
+        key = _device_key(device_parameters)
+        if key is None:
+            return None
+        try:
+            for deviceDetail in self.iter_device_details():
+                if _device_key(deviceDetail) == key:
+                    return deviceDetail
+        except PnpListingError as e:
+            print('Error: ' + str(e))
+        return None
+
+    def iter_device_details(self, page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+        """ Generator of the raw device records of the project, one page at a time
+        """
+        return iter_pages(self.client, '/api/v1/pnp-project/' + self.id + '/device', page_size, prefetch)
+
+    def iter_devices(self, page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+        """ Generator of the devices of the project as PnpDevice objects.  Pages are only fetched as the
+            devices are consumed, so stopping early skips the rest of the listing, and the devices are
+            not added to device_list
+        """
+        for deviceDetail in self.iter_device_details(page_size, prefetch):
+            device = PnpDevice()
+            device.projectId = self.id
+            device.populate_device(deviceDetail)
+            yield device
 
     def get_device_by_name(self, name):
-        if name in self.device_list:
-            return self.device_list[name]
-        else:
+        device = self.device_list.get_by_name(name)
+        if device is None:
             print('Error: Device Name not in Project')
-            return None
+        return device
 
     def get_device_by_id(self, id):
-        for device in self.device_list:
-            if self.device_list[device].id == id:
-                return self.device_list[device]
+        device = self.device_list.get_by_id(id)
+        if device is None:
+            print('Error: Unable to locate device with that Id')
+        return device
+
+    def get_device_by_serial(self, serial_number):
+        device = self.device_list.get_by_serial(serial_number)
+        if device is None:
+            print('Error: Unable to locate device with that Serial Number')
+        return device
+
+    def get_devices_by_state(self, state):
+        """ Devices added since the project was last read have no state yet, call get_project_by_id
+            first to group them by the state APIC-EM gave them
+        """
+        return self.device_list.with_state(state)
 
-        print('Error: Unable to locate device with that Id')
-        return None
+    def get_devices_by_platform(self, platform_id):
+        return self.device_list.with_platform(platform_id)
 
     def get_project_by_name(self, name):
-        response = make_rest_call(self.credentials, GET, '/api/v1/pnp-project?offset=1&limit=500')
-        value = response['response']
-        if 'errorCode' in value:
-            print('Error: Unable to get Project: ' + value['message'] + ' (' + value['detail'] + ')')
+        if self.cache is not None:
+            # The cached id is checked against APIC-EM, in case the project was renamed, before
+            # anything is read into this object
+            value = self.cache.get_project_by_name(name)
+            if value is not None:
+                record = self._read_project(value['id'])
+                if record is not None and record.get('siteName') == name:
+                    return self._load_project(value['id'], record)
+        try:
+            for project in iter_pages(self.client, '/api/v1/pnp-project'):
+                if project['siteName'] == name:
+                    return self.get_project_by_id(project['id'])
+        except PnpListingError as e:
+            print('Error: ' + str(e))
             return None
 
-        for project in value:
-            if project['siteName'] == name:
-                return self.get_project_by_id(project['id'])
-
         print('Unable to locate Project: ' + name)
         return None
 
     def get_project_by_id(self, id, get_devices=True):
-        response = make_rest_call(self.credentials, GET, '/api/v1/pnp-project/' + id)
+        """ Reads the project, and unless get_devices is False its devices, into this object.  With a
+            cache, the devices are read from the cache when the project hasn't changed since it was
+            cached, and cached when they are read from APIC-EM.  Returns the project id, or None
+        """
+        value = self._read_project(id)
+        if value is None:
+            return None
+        return self._load_project(id, value, get_devices)
+
+    def _read_project(self, id):
+        """ Returns the project record of id from APIC-EM, or None
+        """
+        response = make_rest_call(self.client, GET, '/api/v1/pnp-project/' + id)
+        if not response:
+            print('Error: Unable to get Project: ' + id)
+            return None
         value = response['response']
         if 'errorCode' in value:
             print('Error: Unable to get Project: ' + value['message'] + ' (' + value['detail'] + ')')
             return None
+        return value
 
+    def _load_project(self, id, value, get_devices=True):
         self.id = id
-        if 'state' in value: self.state = value['state']
-        if 'provisionedBy' in value: self.provisionedBy = value['provisionedBy']
-        if 'provisionedOn' in value: self.provisionedOn = value['provisionedOn']
-        if 'siteName' in value: self.siteName = value['siteName']
-        if 'tftpServer' in value: self.tftpServer = value['tftpServer']
-        if 'tftpPath' in value: self.tftpPath = value['tftpPath']
-        if 'note' in value: self.note = value['note']
-        if 'deviceCount' in value: self.deviceCount = value['deviceCount']
-        if 'pendingDeviceCount' in value: self.pendingDeviceCount = value['pendingDeviceCount']
-        if 'deviceLastUpdate' in value: self.deviceLastUpdate = value['deviceLastUpdate']
-        if 'installerUserID' in value: self.installerUserID = value['installerUserID']
-
-        if get_devices and self.deviceCount > 0:
-            response = make_rest_call(self.credentials, GET, '/api/v1/pnp-project/' + id + '/device?offset=1&limit=500')
-            for deviceDetail in response['response']:
-                device = PnpDevice()
-                if 'errorCode' in deviceDetail:
-                    print('Error: Unable to get Devices: ' + deviceDetail['message'] + ' (' + deviceDetail['detail'] + ')')
-                    return None
+        self.populate_project(value)
+
+        if get_devices:
+            self.device_list.clear()
+        try:
+            if get_devices and self.cache is not None:
+                if self.cache.is_current(value):
+                    records = self.cache.devices(id)
+                else:
+                    records = list(self.iter_device_details()) if self.deviceCount else []
+                    if len(records) >= (self.deviceCount or 0):
+                        self.cache.store_project(value, records)
+                for deviceDetail in records:
+                    device = PnpDevice()
+                    device.projectId = id
+                    device.populate_device(deviceDetail)
+                    self.device_list.add(device)
+            elif get_devices and self.deviceCount > 0:
+                for device in self.iter_devices():
+                    self.device_list.add(device)
+        except PnpListingError as e:
+            # device_list only has the devices that were read
+            print('Error: ' + str(e))
+            self.error = True
+            self.error_reason = str(e)
+            return None
+        return id
 
-                device.populate_device_from_apic(None, self, deviceDetail)
-                self.device_list[device.hostName] = device
+    def populate_project(self, value):
+        """ Sets the project attributes from a project record returned by APIC-EM
+        """
+        for field, field_value in value.items():
+            if field in _PROJECT_FIELD_SET:
+                setattr(self, field, field_value)
+
+
+class PnpProject(_PnpProjectBase):
+    def import_manifest(self, path, result_path=None, file_handler=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                        batch_size=MANIFEST_BATCH_SIZE, format=None):
+        """ Adds the devices of a CSV or JSONL manifest (see iter_manifest) to the project.  The rows
+            are read batch_size at a time and added with add_devices, without keeping them in
+            device_list, so memory use doesn't grow with the size of the manifest.
+
+            Every row is checked against DEVICE_FIELDS (plus configName/imageName, or config/image,
+            which are looked up through file_handler) and needs a hostName or serialNumber.  When
+            result_path is given, a line per row (MANIFEST_RESULT_FIELDS, with status added, failed or
+            invalid) is written to it as the rows are done, as CSV if it ends with .csv and as JSONL
+            otherwise.  Returns the number of rows, added, failed and invalid rows.
+        """
+        if file_handler is None:
+            file_handler = PnpFileHandler(self.client)
+        counts = {'rows': 0, 'added': 0, 'failed': 0, 'invalid': 0}
+        result_file = None
+        write_result = None
+        if result_path is not None:
+            result_file = open(result_path, 'w', newline='')
+            if _manifest_format(result_path) == 'csv':
+                writer = csv.DictWriter(result_file, MANIFEST_RESULT_FIELDS)
+                writer.writeheader()
+                write_result = writer.writerow
+            else:
+                write_result = lambda result: result_file.write(json.dumps(result) + '\n')
+
+        def done(line, device_parameters, status, id=None, error_reason=''):
+            counts[status] += 1
+            if write_result is not None:
+                write_result({'line': line, 'hostName': device_parameters.get('hostName'),
+                              'serialNumber': device_parameters.get('serialNumber'), 'status': status,
+                              'id': id, 'error_reason': error_reason})
+
+        def add(batch):
+            devices = self.add_devices([device_parameters for line, device_parameters in batch], chunk_size, keep=False)
+            for (line, device_parameters), device in zip(batch, devices):
+                if device.error:
+                    done(line, device_parameters, 'failed', error_reason=device.error_reason)
+                else:
+                    done(line, device_parameters, 'added', device.id)
+            if result_file is not None:
+                result_file.flush()
+
+        try:
+            batch = []
+            for line, row in iter_manifest(path, format):
+                counts['rows'] += 1
+                device_parameters, error_reason = _manifest_device_parameters(row, file_handler)
+                if error_reason is not None:
+                    done(line, row or {}, 'invalid', error_reason=error_reason)
+                    continue
+                batch.append((line, device_parameters))
+                if len(batch) >= batch_size:
+                    add(batch)
+                    batch = []
+            if batch:
+                add(batch)
+        finally:
+            if result_file is not None:
+                result_file.close()
+        return counts
+
+    def watch(self, callback=None, interval=WATCH_INTERVAL, max_interval=WATCH_MAX_INTERVAL, backoff=WATCH_BACKOFF,
+              timeout=None, stop=None):
+        """ Watches the devices of the project for state changes, until timeout seconds have passed or
+            stop (a threading.Event) is set.  Without callback it returns a generator of the change events,
+            otherwise callback(event) is called for each of them.
+
+            An event is a dictionary of {'type': 'added', 'changed' or 'removed', 'project', 'device' (a
+            PnpDevice), 'old_state', 'new_state', 'error' (True if new_state is in DEVICE_ERROR_STATES)}.
+            The devices present when the watch starts are not reported.
+
+            The project is polled every interval seconds after a change, and less often (up to
+            max_interval) while nothing changes.  A poll is one request for the project, the devices
+            are only listed when the project's deviceLastUpdate, pendingDeviceCount or deviceCount
+            changed.  Use watch_projects to watch many projects at once.
+        """
+        return watch_projects([self], callback, interval, max_interval, backoff, timeout, stop, workers=1)
+
+    def sync(self, desired_devices, desired_files=None, key='hostName', delete=False, dry_run=False,
+             file_handler=None, workers=DEFAULT_WORKERS, chunk_size=DEFAULT_CHUNK_SIZE):
+        """ Makes the project on APIC-EM match a desired state, sending only the changes.
+
+            desired_devices is a list of device_parameters dictionaries (or PnpDevice objects), matched
+            to the devices of the project by key ('hostName' or 'serialNumber').  A device can refer to
+            its files by name with 'configName' and 'imageName' instead of configId and imageId.
+            desired_files is a list of config file paths, or a dictionary of {'config': [paths],
+            'image': [paths]}, that must be on APIC-EM (a file whose content changed is replaced).
+
+            The project (created if it doesn't exist yet and siteName is set), its devices and the file
+            namespaces are read once, and the plan is computed from them:
+                upload: (type, path) of the files to upload
+                create: device_parameters of the devices to add
+                update: device_parameters of the devices to change
+                delete: PnpDevice objects of the devices to remove (only with delete=True)
+                unchanged: keys of the devices that already match
+                errors: {'key', 'error_reason'} of the operations that failed, and of the devices that
+                        aren't sent (no key, or a file that couldn't be located or uploaded)
+            With dry_run the plan is returned without changing anything, otherwise it is applied with
+            up to workers operations at once and the plan is returned.
+        """
+        plan = {'upload': [], 'create': [], 'update': [], 'delete': [], 'unchanged': [], 'errors': []}
+        if file_handler is None:
+            file_handler = PnpFileHandler(self.client)
+        if desired_files is None:
+            desired_files = {}
+        elif isinstance(desired_files, (list, tuple)):
+            desired_files = {'config': desired_files}
+
+        if self.id is None:
+            try:
+                for project in iter_pages(self.client, '/api/v1/pnp-project'):
+                    if project['siteName'] == self.siteName:
+                        self.id = project['id']
+                        break
+            except PnpListingError as e:
+                # Creating the project could duplicate one on the pages that couldn't be read
+                plan['errors'].append({'key': self.siteName, 'error_reason': str(e)})
+                return plan
+        if self.id is None and not dry_run:
+            if self.create_project() is None:
+                plan['errors'].append({'key': self.siteName, 'error_reason': self.error_reason})
+                return plan
+
+        # Files
+        file_ids = {'config': {}, 'image': {}}
+        failed_uploads = {'config': set(), 'image': set()}
+        for type in desired_files:
+            for path in desired_files[type]:
+                name = _upload_name(os.path.basename(path), type)
+                file = file_handler._lookup_file('name', name, type)
+                if file is None or file.get('md5Checksum') != file_checksum(path):
+                    plan['upload'].append((type, path))
+                else:
+                    file_ids[type][name] = file['id']
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            if not dry_run:
+                def upload(item):
+                    type, path = item
+                    name = _upload_name(os.path.basename(path), type)
+                    old_id = file_handler.get_file_id_by_name(name, type)
+                    if old_id is not None:
+                        file_handler.delete_file(old_id, type, check=False)
+                    return file_handler.upload_file(path, type, dedupe=False)
+                for (type, path), file_id in zip(plan['upload'], executor.map(upload, plan['upload'])):
+                    name = _upload_name(os.path.basename(path), type)
+                    if file_id is None:
+                        plan['errors'].append({'key': path, 'error_reason': 'Unable to upload file'})
+                        failed_uploads[type].add(name)
+                    else:
+                        file_ids[type][name] = file_id
+            else:
+                for type, path in plan['upload']:
+                    name = _upload_name(os.path.basename(path), type)
+                    file_ids[type][name] = '<upload ' + name + '>'
+
+            # Devices
+            current = {}
+            if self.id is not None:
+                self.device_list.clear()
+                try:
+                    for device in self.iter_devices():
+                        current[getattr(device, key)] = device
+                        self.device_list.add(device)
+                except PnpListingError as e:
+                    # Without every current device the plan would create duplicates and miss deletes
+                    plan['errors'].append({'key': self.siteName, 'error_reason': str(e)})
+                    return plan
+
+            desired_keys = set()
+            for device_parameters in desired_devices:
+                if isinstance(device_parameters, PnpDevice):
+                    device_parameters = device_parameters.create_device_parameters()
+                if device_parameters.get(key) is None:
+                    plan['errors'].append({'key': None, 'error_reason': key + ' is required'})
+                    continue
+                # A device whose file is missing is not sent, it would be provisioned without it
+                error_reason = None
+                for name_field, (id_field, type) in DEVICE_FILE_FIELDS.items():
+                    name = device_parameters.get(name_field)
+                    if name is not None and name in failed_uploads[type]:
+                        error_reason = 'Unable to upload ' + type + ' file: ' + str(name)
+                        break
+                if error_reason is None:
+                    resolved = _resolve_file_names(device_parameters, file_handler, file_ids)
+                    for name_field, (id_field, type) in DEVICE_FILE_FIELDS.items():
+                        if name_field in device_parameters and resolved[id_field] is None:
+                            error_reason = 'Unable to locate ' + type + ' file: ' + str(device_parameters[name_field])
+                            break
+                # Its current device is kept, even with delete
+                desired_keys.add(device_parameters.get(key))
+                if error_reason is not None:
+                    plan['errors'].append({'key': device_parameters.get(key), 'error_reason': error_reason})
+                    continue
+                device_parameters = resolved
+                device = current.get(device_parameters.get(key))
+                if device is None:
+                    plan['create'].append(device_parameters)
+                    continue
+                changes = dict((field, value) for field, value in device_parameters.items()
+                               if field in _DEVICE_FIELD_SET and field != 'id' and getattr(device, field) != value)
+                if changes:
+                    update_parameters = device.create_device_parameters()
+                    update_parameters.update(changes)
+                    plan['update'].append(update_parameters)
+                else:
+                    plan['unchanged'].append(device_parameters.get(key))
+            if delete:
+                plan['delete'] = [device for device_key, device in current.items() if device_key not in desired_keys]
+
+            if dry_run:
+                return plan
+        finally:
+            executor.shutdown()
+
+        # update_devices, delete_devices and add_devices keep device_list up to date
+        changed = []
+        if plan['update']:
+            changed.extend(self.update_devices(plan['update'], chunk_size))
+        if plan['delete']:
+            changed.extend(self.delete_devices(plan['delete'], workers))
+        if plan['create']:
+            changed.extend(self.add_devices(plan['create'], chunk_size))
+        for device in changed:
+            if device.error:
+                plan['errors'].append({'key': getattr(device, key), 'error_reason': device.error_reason})
+        return plan
 
 
 class PnpDevice:
+    """ The APIC-EM attributes of a device are declared once in DEVICE_FIELDS.  The device is stored in
+        __slots__, so loading tens of thousands of devices doesn't pay for a __dict__ per device.
+    """
+    __slots__ = ('error', 'error_reason', 'projectId') + DEVICE_FIELDS
+
     def __init__(self):
         self.error = False
         self.error_reason = ''
+        self.projectId = None
         #APIC-EM PnP Device Attribues:
-        self.state = None
-        self.authStatus = None
-        self.lastContact = None
-        self.deviceId = None
-        self.lastStateTransitionTime = None
-        self.stateDisplay = None
-        self.hostName = None
-        self.serialNumber = None
-        self.tag = None
-        self.id = None
-        self.platformId = None
-        self.site = None
-        self.imageId = None
-        self.configId = None
-        self.bootStrapId = None
-        self.licenseString = None
-        self.apCount = None
-        self.isMobilityController = None
-        self.pkiEnabled = None
-        self.sudiRequired = None
-        self.connectedToDeviceId = None
-        self.connectedToPortId = None
-        self.connectedToPortName = None
-        self.connetedToLocationCivicAddr = None
-        self.imagePreference = None
-        self.connectedToDeviceHostName = None
-        self.connetedToLocationGeoAddr = None
-        self.configPreference = None
-        self.attributeInfo = None
+        for field in DEVICE_FIELDS:
+            setattr(self, field, None)
 
     def create_device(self, project, device_parameters=None):
         """ device_parameters needs to be a dictionary of the following format (not all fields required):
@@ -425,91 +2726,615 @@ class PnpDevice:
         if device_parameters is None:
             device_parameters = self.create_device_parameters()
 
-        response = make_rest_call(project.credentials, POST, '/api/v1/pnp-project/' + project.id + '/device', [device_parameters])
-        task_status = get_task_id(project.credentials, response['response']['taskId'])
+        response = make_rest_call(project.client, POST, '/api/v1/pnp-project/' + project.id + '/device', [device_parameters])
+        if not response or 'taskId' not in response['response']:
+            self.error = True
+            self.error_reason = 'Unable to add device to Project'
+            return None
+        task_status = get_task_id(project.client, response['response']['taskId'])
 
         if (task_status['isError']):
             self.error = True
             self.error_reason = task_status['failureReason']
             return None
         else:
-            if task_status['progress'].find('ruleId'):
-                progress_json = ast.literal_eval(task_status['progress'])
-                self.id = progress_json['ruleId']
-                self.projectId = project.id
-                self.populate_device_from_apic(self.id, project)
-                print('Device Added to Project: ' + self.hostName + ' (' + self.id + ') added to Project ' + project.siteName + ' (' + project.id + ')')
+            self.projectId = project.id
+            rule_ids = get_task_rule_ids(task_status)
+            if rule_ids:
+                # The device record is built from what was sent, so adding a device doesn't download
+                # the device list of the project
+                self.populate_device(device_parameters)
+                self.id = rule_ids[0]
+            else:
+                deviceDetail = project.find_device_detail(device_parameters)
+                if deviceDetail is None:
+                    self.error = True
+                    self.error_reason = 'Unable to locate device after adding it to Project'
+                    return None
+                self.populate_device(deviceDetail)
+            print('Device Added to Project: ' + str(self.hostName) + ' (' + self.id + ') added to Project ' + project.siteName + ' (' + project.id + ')')
+
+    def update_device(self, project, device_parameters=None):
+        """ Pushes the local changes of the device (or device_parameters, which must include the id)
+            to APIC-EM
+        """
+        if device_parameters is None:
+            device_parameters = self.create_device_parameters()
+
+        response = make_rest_call(project.client, PUT, '/api/v1/pnp-project/' + project.id + '/device', [device_parameters])
+        if not response or 'taskId' not in response['response']:
+            self.error = True
+            self.error_reason = 'Unable to update device'
+            return None
+        task_status = get_task_id(project.client, response['response']['taskId'])
+
+        if (task_status['isError']):
+            self.error = True
+            self.error_reason = task_status['failureReason']
+            return None
+        self.error = False
+        self.error_reason = ''
+        self.projectId = project.id
+        self.populate_device(device_parameters)
+        project.device_list.add(self)
+        return self.id
+
+    def delete_device(self, project):
+        """ Removes the device from the project on APIC-EM
+        """
+        response = make_rest_call(project.client, DELETE, '/api/v1/pnp-project/' + project.id + '/device/' + self.id)
+        if not response or 'taskId' not in response['response']:
+            self.error = True
+            self.error_reason = 'Unable to delete device'
+            return None
+        task_status = get_task_id(project.client, response['response']['taskId'])
+
+        if (task_status['isError']):
+            self.error = True
+            self.error_reason = task_status['failureReason']
+            return None
+        self.error = False
+        self.error_reason = ''
+        project.device_list.remove(self)
+        return True
 
     def create_device_parameters(self):
-        device_parameters = {}
-        if self.state is not None: device_parameters['state'] = self.state
-        if self.authStatus is not None: device_parameters['authStatus'] = self.authStatus
-        if self.lastContact is not None: device_parameters['lastContact'] = self.lastContact
-        if self.deviceId is not None: device_parameters['deviceId'] = self.deviceId
-        if self.lastStateTransitionTime is not None: device_parameters['lastStateTransitionTime'] = self.lastStateTransitionTime
-        if self.stateDisplay is not None: device_parameters['stateDisplay'] = self.stateDisplay
-        if self.hostName is not None: device_parameters['hostName'] = self.hostName
-        if self.serialNumber is not None: device_parameters['serialNumber'] = self.serialNumber
-        if self.tag is not None: device_parameters['tag'] = self.tag
-        if self.id is not None: device_parameters['id'] = self.id
-        if self.platformId is not None: device_parameters['platformId'] = self.platformId
-        if self.site is not None: device_parameters['site'] = self.site
-        if self.imageId is not None: device_parameters['imageId'] = self.imageId
-        if self.configId is not None: device_parameters['configId'] = self.configId
-        if self.bootStrapId is not None: device_parameters['bootStrapId'] = self.bootStrapId
-        if self.licenseString is not None: device_parameters['licenseString'] = self.licenseString
-        if self.apCount is not None: device_parameters['apCount'] = self.apCount
-        if self.isMobilityController is not None: device_parameters['isMobilityController'] = self.isMobilityController
-        if self.pkiEnabled is not None: device_parameters['pkiEnabled'] = self.pkiEnabled
-        if self.sudiRequired is not None: device_parameters['sudiRequired'] = self.sudiRequired
-        if self.connectedToDeviceId is not None: device_parameters['connectedToDeviceId'] = self.connectedToDeviceId
-        if self.connectedToPortId is not None: device_parameters['connectedToPortId'] = self.connectedToPortId
-        if self.connectedToPortName is not None: device_parameters['connectedToPortName'] = self.connectedToPortName
-        if self.connetedToLocationCivicAddr is not None: device_parameters['connetedToLocationCivicAddr'] = self.connetedToLocationCivicAddr
-        if self.imagePreference is not None: device_parameters['imagePreference'] = self.imagePreference
-        if self.connectedToDeviceHostName is not None: device_parameters['connectedToDeviceHostName'] = self.connectedToDeviceHostName
-        if self.connetedToLocationGeoAddr is not None: device_parameters['connetedToLocationGeoAddr'] = self.connetedToLocationGeoAddr
-        if self.configPreference is not None: device_parameters['configPreference'] = self.configPreference
-        if self.attributeInfo is not None: device_parameters['attributeInfo'] = self.attributeInfo
-        return device_parameters        
+        return {field: value for field, value in zip(DEVICE_FIELDS, _device_values(self)) if value is not None}
 
     def populate_device_from_apic(self, deviceId, project, deviceDetail=None):
         if deviceId is not None and deviceDetail is None:
-            response = make_rest_call(project.credentials, GET, '/api/v1/pnp-project/' + self.projectId + '/device?offset=1&limit=500')
-            for devicesDetail in response['response']:
-                if 'id' in devicesDetail:
-                    if deviceId == devicesDetail['id']:
-                        deviceDetail = devicesDetail
-
-        if 'state' in deviceDetail: self.state = deviceDetail['state']
-        if 'authStatus' in deviceDetail: self.authStatus = deviceDetail['authStatus']
-        if 'lastContact' in deviceDetail: self.lastContact = deviceDetail['lastContact']
-        if 'deviceId' in deviceDetail: self.deviceId = deviceDetail['deviceId']
-        if 'lastStateTransitionTime' in deviceDetail: self.lastStateTransitionTime = deviceDetail['lastStateTransitionTime']
-        if 'stateDisplay' in deviceDetail: self.stateDisplay = deviceDetail['stateDisplay']
-        if 'hostName' in deviceDetail: self.hostName = deviceDetail['hostName']
-        if 'serialNumber' in deviceDetail: self.serialNumber = deviceDetail['serialNumber']
-        if 'tag' in deviceDetail: self.tag = deviceDetail['tag']
-        if 'id' in deviceDetail: self.id = deviceDetail['id']
-        if 'platformId' in deviceDetail: self.platformId = deviceDetail['platformId']
-        if 'site' in deviceDetail: self.site = deviceDetail['site']
-        if 'imageId' in deviceDetail: self.imageId = deviceDetail['imageId']
-        if 'configId' in deviceDetail: self.configId = deviceDetail['configId']
-        if 'bootStrapId' in deviceDetail: self.bootStrapId = deviceDetail['bootStrapId']
-        if 'licenseString' in deviceDetail: self.licenseString = deviceDetail['licenseString']
-        if 'apCount' in deviceDetail: self.apCount = deviceDetail['apCount']
-        if 'isMobilityController' in deviceDetail: self.isMobilityController = deviceDetail['isMobilityController']
-        if 'pkiEnabled' in deviceDetail: self.pkiEnabled = deviceDetail['pkiEnabled']
-        if 'sudiRequired' in deviceDetail: self.sudiRequired = deviceDetail['sudiRequired']
-        if 'connectedToDeviceId' in deviceDetail: self.connectedToDeviceId = deviceDetail['connectedToDeviceId']
-        if 'connectedToPortId' in deviceDetail: self.connectedToPortId = deviceDetail['connectedToPortId']
-        if 'connectedToPortName' in deviceDetail: self.connectedToPortName = deviceDetail['connectedToPortName']
-        if 'connetedToLocationCivicAddr' in deviceDetail: self.connetedToLocationCivicAddr = deviceDetail['connetedToLocationCivicAddr']
-        if 'imagePreference' in deviceDetail: self.imagePreference = deviceDetail['imagePreference']
-        if 'connectedToDeviceHostName' in deviceDetail: self.connectedToDeviceHostName = deviceDetail['connectedToDeviceHostName']
-        if 'connetedToLocationGeoAddr' in deviceDetail: self.connetedToLocationGeoAddr = deviceDetail['connetedToLocationGeoAddr']
-        if 'configPreference' in deviceDetail: self.configPreference = deviceDetail['configPreference']
-        if 'attributeInfo' in deviceDetail: self.attributeInfo = deviceDetail['attributeInfo']
+            for devicesDetail in iter_pages(project.client, '/api/v1/pnp-project/' + self.projectId + '/device'):
+                if devicesDetail.get('id') == deviceId:
+                    deviceDetail = devicesDetail
+                    break
+
+        self.populate_device(deviceDetail)
+
+    def populate_device(self, deviceDetail):
+        """ Sets the device attributes from a device record returned by APIC-EM
+        """
+        for field, value in deviceDetail.items():
+            if field in _DEVICE_FIELD_SET:
+                setattr(self, field, value)
+
+
+class DeviceTable:
+    """ DeviceTable is a read-only, column oriented snapshot of device records, for when every device
+        in the fleet needs to be loaded but not modified.
+
+        Each field is stored as one column instead of one object per device.  The fields that repeat
+        across devices (DEVICE_SHARED_FIELDS: state, platformId, imageId...) are stored as an array of
+        integer codes into the list of their distinct values, so each value is only stored once.
+    """
+    def __init__(self, fields=DEVICE_FIELDS, shared_fields=DEVICE_SHARED_FIELDS):
+        self.fields = tuple(fields)
+        self._columns = {}
+        self._values = {}
+        self._lookup = {}
+        for field in self.fields:
+            if field in shared_fields:
+                self._columns[field] = array('l')
+                self._values[field] = [None]
+                self._lookup[field] = {None: 0}
+            else:
+                self._columns[field] = []
+        self._length = 0
+
+    @classmethod
+    def from_records(cls, records, fields=DEVICE_FIELDS):
+        table = cls(fields)
+        for record in records:
+            table.append(record)
+        return table
+
+    @classmethod
+    def from_project(cls, project, page_size=DEFAULT_PAGE_SIZE, prefetch=True):
+        """ Snapshot of the devices of a PnpProject, read page by page without building PnpDevice objects
+        """
+        return cls.from_records(project.iter_device_details(page_size, prefetch))
+
+    def append(self, record):
+        if isinstance(record, PnpDevice):
+            record = record.create_device_parameters()
+        get = record.get
+        for field in self.fields:
+            value = get(field)
+            lookup = self._lookup.get(field)
+            if lookup is not None:
+                code = lookup.get(value)
+                if code is None:
+                    code = lookup[value] = len(self._values[field])
+                    self._values[field].append(value)
+                value = code
+            self._columns[field].append(value)
+        self._length += 1
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for i in range(self._length):
+            yield self.row(i)
+
+    def value(self, i, field):
+        if field in self._lookup:
+            return self._values[field][self._columns[field][i]]
+        return self._columns[field][i]
+
+    def column(self, field):
+        if field in self._lookup:
+            values = self._values[field]
+            return [values[code] for code in self._columns[field]]
+        return list(self._columns[field])
+
+    def row(self, i):
+        """ Returns device i as a device_parameters dictionary
+        """
+        row = {}
+        for field in self.fields:
+            value = self._columns[field][i]
+            if field in self._lookup:
+                value = self._values[field][value]
+            if value is not None:
+                row[field] = value
+        return row
+
+    def device(self, i):
+        device = PnpDevice()
+        device.populate_device(self.row(i))
+        return device
+
+    def where(self, **criteria):
+        """ Returns the indexes of the devices matching every field=value in criteria
+        """
+        matches = range(self._length)
+        for field, value in criteria.items():
+            column = self._columns[field]
+            if field in self._lookup:
+                value = self._lookup[field].get(value)
+                if value is None:
+                    return []
+            matches = [i for i in matches if column[i] == value]
+        return list(matches)
+
+    def count_by(self, field):
+        """ Returns a dictionary of {value: number of devices} for field
+        """
+        counts = {}
+        for value in self.column(field):
+            counts[value] = counts.get(value, 0) + 1
+        return counts
+
+
+class FleetSnapshot:
+    """ FleetSnapshot holds the devices of every project of a server at one point in time (see
+        fleet_snapshot), in a DeviceTable with the projectId, siteName and errorReason of each device
+        added as columns.  errorReason is only set for the devices in DEVICE_ERROR_STATES.
+
+        failed lists the projects whose devices couldn't be read completely, as dictionaries of
+        {'project', 'error_reason'}; the devices that were read are still in the snapshot.  If the
+        project listing itself couldn't be read completely, it is in failed with project None.
+    """
+    FIELDS = DEVICE_FIELDS + ('projectId', 'siteName', 'errorReason')
+
+    def __init__(self):
+        self.taken = time.time()
+        self.projects = {}
+        self.failed = []
+        self.table = DeviceTable(self.FIELDS, DEVICE_SHARED_FIELDS | frozenset(('projectId', 'siteName', 'errorReason')))
+
+    @property
+    def complete(self):
+        return not self.failed
+
+    def __len__(self):
+        return len(self.table)
+
+    def add_project(self, project, records):
+        self.projects[project.id] = project
+        for record in records:
+            record = dict(record, projectId=project.id, siteName=project.siteName)
+            if record.get('state') in DEVICE_ERROR_STATES:
+                for field in DEVICE_ERROR_REASON_FIELDS:
+                    if record.get(field):
+                        record['errorReason'] = record[field]
+                        break
+            self.table.append(record)
+
+    def add_failure(self, project, error_reason):
+        self.failed.append({'project': project, 'error_reason': error_reason})
+
+    def devices(self, **criteria):
+        """ Returns the device records (dictionaries) matching every field=value in criteria,
+            ex: snapshot.devices(state='ERROR', platformId='WS-C3650-48PQ')
+        """
+        return [self.table.row(i) for i in self.table.where(**criteria)]
+
+    def count_by(self, field):
+        return self.table.count_by(field)
+
+    def group_by(self, field, **criteria):
+        """ Returns a dictionary of {value of field: [device records]} of the devices matching criteria
+        """
+        groups = {}
+        for i in self.table.where(**criteria):
+            groups.setdefault(self.table.value(i, field), []).append(self.table.row(i))
+        return groups
+
+    def by_state(self):
+        return self.count_by('state')
+
+    def by_platform(self):
+        return self.count_by('platformId')
+
+    def by_error_reason(self):
+        counts = self.count_by('errorReason')
+        counts.pop(None, None)
+        return counts
+
+
+def fleet_snapshot(credentials, workers=DEFAULT_WORKERS, page_size=DEFAULT_PAGE_SIZE):
+    """ Lists every project of the server (page by page) and reads the devices of up to workers projects
+        at once.  Returns a FleetSnapshot; the projects whose devices couldn't be read are in its failed
+        list and the snapshot holds everything else.
+    """
+    snapshot = FleetSnapshot()
+
+    def read_devices(project):
+        if project.deviceCount == 0:
+            return []
+        return list(project.iter_device_details(page_size))
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {}
+        try:
+            for project in iter_projects(credentials, page_size):
+                futures[executor.submit(read_devices, project)] = project
+        except PnpListingError as e:
+            # The projects that were listed are still read
+            snapshot.add_failure(None, str(e))
+        for future in as_completed(futures):
+            project = futures[future]
+            try:
+                records = future.result()
+            except Exception as e:
+                snapshot.add_failure(project, 'Unable to read devices: %s' % e)
+                continue
+            snapshot.add_project(project, records)
+            if project.deviceCount and len(records) < project.deviceCount:
+                snapshot.add_failure(project, 'Read %d of %d devices' % (len(records), project.deviceCount))
+    finally:
+        executor.shutdown()
+    return snapshot
+
+
+class PnpControllerGroup:
+    """ PnpControllerGroup holds several APIC-EM controllers (servers), each with its own PnpClient and
+        connection pool, and runs the same operation on all of them at once.
+
+        Projects are routed to a server by siteName: site_servers maps a siteName to its server, and
+        the other sites are spread over the servers by a hash of the siteName, which stays the same
+        from run to run as long as the list of servers doesn't change.  The bulk methods return their
+        results per server, as a dictionary of {server: result}.
+    """
+    def __init__(self, clients, site_servers=None):
+        if isinstance(clients, dict):
+            clients = clients.values()
+        self.clients = {}
+        for credentials in clients:
+            client = get_client(credentials)
+            self.clients[client.server] = client
+        self.servers = sorted(self.clients)
+        self.site_servers = dict(site_servers or {})
+        self.failed = []
+        self._file_handlers = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def login(cls, username, password, servers, site_servers=None, **client_options):
+        """ Logs in to every server at once (see pnp_login) and returns the group of the servers that
+            could be logged in to, the others are listed in failed
+        """
+        def login(server):
+            try:
+                return pnp_login(username, password, server, **client_options)
+            except requests.exceptions.RequestException as e:
+                print('Error: %s' % e)
+                return None
+
+        executor = ThreadPoolExecutor(max_workers=max(len(servers), 1))
+        try:
+            clients = list(executor.map(login, servers))
+        finally:
+            executor.shutdown()
+        group = cls([client for client in clients if client is not None], site_servers)
+        for server, client in zip(servers, clients):
+            if client is None:
+                print('Error: Unable to log in to ' + server)
+                group.failed.append(server)
+        return group
+
+    def server_for(self, site_name):
+        if site_name in self.site_servers:
+            return self.site_servers[site_name]
+        digest = hashlib.md5(site_name.encode('utf-8')).hexdigest()
+        return self.servers[int(digest, 16) % len(self.servers)]
+
+    def client_for(self, site_name):
+        return self.clients[self.server_for(site_name)]
+
+    def file_handler(self, server):
+        """ Returns the PnpFileHandler of a server, shared by the operations of the group
+        """
+        with self._lock:
+            if server not in self._file_handlers:
+                self._file_handlers[server] = PnpFileHandler(self.clients[server])
+            return self._file_handlers[server]
+
+    def get_project(self, site_name):
+        """ Returns the PnpProject of site_name (with its devices) from its server, or None
+        """
+        project = PnpProject(self.client_for(site_name))
+        if project.get_project_by_name(site_name) is None:
+            return None
+        return project
+
+    def map(self, function, servers=None):
+        """ Calls function(server, client) for every server (or the given ones) at once and returns
+            {server: result}.  A server whose call raised gets None
+        """
+        if servers is None:
+            servers = self.servers
+        results = {}
+        executor = ThreadPoolExecutor(max_workers=max(len(servers), 1))
+        try:
+            futures = dict((executor.submit(function, server, self.clients[server]), server) for server in servers)
+            for future in as_completed(futures):
+                server = futures[future]
+                try:
+                    results[server] = future.result()
+                except Exception as e:
+                    print('Error: %s failed on %s: %s' % (getattr(function, '__name__', 'operation'), server, e))
+                    results[server] = None
+        finally:
+            executor.shutdown()
+        return results
+
+    def upload_file(self, path, type='config', dedupe=True):
+        """ Uploads a file to every server and returns {server: file id}
+        """
+        return self.map(lambda server, client: self.file_handler(server).upload_file(path, type, dedupe=dedupe))
+
+    def create_projects(self, projects, workers=DEFAULT_WORKERS):
+        """ Creates projects on the servers their siteName is routed to.  projects is a list of siteNames
+            and/or project_parameters dictionaries; up to workers projects are created at once on each
+            server.  Returns {server: [PnpProject]}, with error and error_reason set on the projects
+            that failed
+        """
+        by_server = {}
+        for project_parameters in projects:
+            if not isinstance(project_parameters, dict):
+                project_parameters = {'siteName': project_parameters}
+            by_server.setdefault(self.server_for(project_parameters['siteName']), []).append(project_parameters)
+
+        def create(server, client):
+            def create_project(project_parameters):
+                project = PnpProject(client)
+                project.siteName = project_parameters['siteName']
+                try:
+                    project.create_project(project_parameters)
+                except Exception as e:
+                    project.error = True
+                    project.error_reason = 'Unable to create project: %s' % e
+                return project
+            executor = ThreadPoolExecutor(max_workers=workers)
+            try:
+                return list(executor.map(create_project, by_server[server]))
+            finally:
+                executor.shutdown()
+        return self.map(create, sorted(by_server))
+
+    def fleet_snapshot(self, workers=DEFAULT_WORKERS, page_size=DEFAULT_PAGE_SIZE):
+        """ Takes a fleet_snapshot of every server at once and returns {server: FleetSnapshot}
+        """
+        return self.map(lambda server, client: fleet_snapshot(client, workers, page_size))
+
+
+class ProvisioningPipeline:
+    """ Provisions devices in two stages that run at the same time: the upload stage uploads the
+        config of each device (PnpFileHandler.upload_file), the create stage adds the device to the
+        project (PnpProject.add_device_with_parameters).  Each stage has its own pool of workers and
+        a queue of at most queue_size items in front of it, so a slow stage holds back the one
+        feeding it instead of piling up work in memory.
+
+        With journal_path, every finished step is appended to a journal (one JSON object per line).
+        When the pipeline is run again with the same journal, devices that were already created are
+        skipped and configs that were already uploaded are not uploaded again, so an interrupted run
+        picks up where it stopped.
+    """
+    STAGES = ('upload', 'create')
+
+    def __init__(self, project, file_handler, journal_path=None, upload_workers=DEFAULT_WORKERS,
+                 create_workers=DEFAULT_WORKERS, queue_size=PIPELINE_QUEUE_SIZE, type='config'):
+        self.project = project
+        self.file_handler = file_handler
+        self.journal_path = journal_path
+        self.workers = {'upload': upload_workers, 'create': create_workers}
+        self.queue_size = queue_size
+        self.type = type
+        self.results = {}
+        self.stats = {}
+        self._journal = None
+        self._lock = threading.Lock()
+
+    def run(self, items):
+        """ Runs the pipeline over items, an iterable of (config path, device_parameters).  The path
+            may be None for a device without a config, otherwise the configId of the device is set
+            to the id of the uploaded file.  Items are read as the upload stage makes room for
+            them, so items can be a generator over a very large directory.
+
+            Returns a dictionary of {device key: device id (or None if the device couldn't be
+            created)}, the device key being 'hostName:<name>' (or 'serialNumber:<serial>').
+            Throughput of each stage is in stats once the run returns.
+        """
+        done = self._read_journal()
+        self.results = {}
+        self.stats = dict((stage, {'processed': 0, 'failed': 0, 'skipped': 0, 'busy': 0.0,
+                                   'start': None, 'end': None}) for stage in self.STAGES)
+        queues = {'upload': queue.Queue(self.queue_size), 'create': queue.Queue(self.queue_size)}
+
+        if self.journal_path is not None:
+            self._journal = open(self.journal_path, 'a')
+            if self._journal.tell() and not self._journal_ends_with_newline():
+                self._journal.write('\n')
+        try:
+            threads = {}
+            for stage, work in (('upload', self._upload), ('create', self._create)):
+                next_queue = queues['create'] if stage == 'upload' else None
+                threads[stage] = [threading.Thread(target=self._worker, args=(stage, work, queues[stage], next_queue))
+                                  for i in range(self.workers[stage])]
+                for thread in threads[stage]:
+                    thread.daemon = True
+                    thread.start()
+
+            for path, device_parameters in items:
+                key = _device_key(device_parameters)
+                if key is None:
+                    print('Error: Device has neither a hostName nor a serialNumber, skipping')
+                    continue
+                key = '%s:%s' % key
+                previous = done.get(key, {})
+                if 'create' in previous:
+                    self.results[key] = previous['create']
+                    self._count('upload', 'skipped')
+                    self._count('create', 'skipped')
+                    continue
+                item = {'key': key, 'path': path, 'device': dict(device_parameters)}
+                if 'upload' in previous:
+                    # Already uploaded, it goes straight to the create stage
+                    item['device']['configId' if self.type == 'config' else 'imageId'] = previous['upload']
+                    self._count('upload', 'skipped')
+                    queues['create'].put(item)
+                    continue
+                # Blocks while the upload stage is queue_size items behind
+                queues['upload'].put(item)
+
+            for stage in self.STAGES:
+                for thread in threads[stage]:
+                    queues[stage].put(None)
+                for thread in threads[stage]:
+                    thread.join()
+        finally:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+        for stage in self.STAGES:
+            stats = self.stats[stage]
+            stats['elapsed'] = stats['end'] - stats['start'] if stats['start'] is not None else 0.0
+            stats['per_second'] = stats['processed'] / stats['elapsed'] if stats['elapsed'] else 0.0
+            del stats['start'], stats['end']
+        return self.results
+
+    def _worker(self, stage, work, in_queue, out_queue):
+        while True:
+            item = in_queue.get()
+            if item is None:
+                return
+            start = time.time()
+            try:
+                ok = work(item)
+            except Exception:
+                traceback.print_exc()
+                ok = False
+            end = time.time()
+            with self._lock:
+                stats = self.stats[stage]
+                if stats['start'] is None or start < stats['start']:
+                    stats['start'] = start
+                if stats['end'] is None or end > stats['end']:
+                    stats['end'] = end
+                stats['busy'] += end - start
+                if ok:
+                    stats['processed'] += 1
+                else:
+                    stats['failed'] += 1
+                    self.results[item['key']] = None
+            if ok and out_queue is not None:
+                out_queue.put(item)
+
+    def _upload(self, item):
+        if item['path'] is None:
+            return True
+        file_id = self.file_handler.upload_file(item['path'], self.type)
+        if file_id is None:
+            print('Error: Unable to upload ' + item['path'])
+            return False
+        item['device']['configId' if self.type == 'config' else 'imageId'] = file_id
+        self._write_journal('upload', item['key'], file_id)
+        return True
+
+    def _create(self, item):
+        device = self.project.add_device_with_parameters(item['device'])
+        if device is None:
+            return False
+        with self._lock:
+            self.results[item['key']] = device.id
+        self._write_journal('create', item['key'], device.id)
+        return True
+
+    def _count(self, stage, counter):
+        with self._lock:
+            self.stats[stage][counter] += 1
+
+    def _write_journal(self, stage, key, value):
+        if self._journal is None:
+            return
+        with self._lock:
+            self._journal.write(json.dumps({'stage': stage, 'key': key, 'id': value}) + '\n')
+            self._journal.flush()
+
+    def _journal_ends_with_newline(self):
+        with open(self.journal_path, 'rb') as journal:
+            journal.seek(-1, os.SEEK_END)
+            return journal.read(1) == b'\n'
+
+    def _read_journal(self):
+        """ Returns {device key: {stage: id}} of the steps recorded in the journal.  A line cut short
+            by a crash is ignored
+        """
+        done = {}
+        if self.journal_path is None or not os.path.isfile(self.journal_path):
+            return done
+        with open(self.journal_path) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                done.setdefault(entry['key'], {})[entry['stage']] = entry['id']
+        return done
 
 
 def main():
@@ -0,0 +1,259 @@
+#!/usr/bin/python
+import io
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+
+from PnpProject import *
+from mock_apicem import MockApicEm
+
+# Benchmarks for PnpProject.
+#   python benchmark_script.py model 50000          memory and load time of the device model for 50000 devices
+#   python benchmark_script.py api 10 100 1000       wall time and request counts against the mock APIC-EM
+#   python benchmark_script.py overload 12           fixed workers vs PnpConcurrencyController on a mock
+#                                                    that rejects requests past its capacity
+# Without arguments both are run with their default sizes.
+
+# Latency (seconds) the mock adds to every response, and the time its tasks take to complete
+MOCK_LATENCY = 0.002
+MOCK_TASK_DELAY = 0.05
+API_SIZES = (10, 100, 1000, 10000)
+# add_device_with_parameters waits on a task per device, it is only measured up to this many devices
+MAX_SINGLE_ADDS = 100
+FILE_COUNT = 200
+# Requests the overloaded mock handles at once, and the workers thrown at it
+MOCK_CAPACITY = 12
+OVERLOAD_WORKERS = 40
+OVERLOAD_PROJECTS = 20
+
+
+class LegacyDevice:
+    """ PnpDevice as it was before DEVICE_FIELDS: attributes in a __dict__, set and read one field at a time
+    """
+    def __init__(self):
+        self.error = False
+        self.error_reason = ''
+        for field in DEVICE_FIELDS:
+            setattr(self, field, None)
+
+    def populate_device(self, deviceDetail):
+        for field in DEVICE_FIELDS:
+            if field in deviceDetail:
+                setattr(self, field, deviceDetail[field])
+
+    def create_device_parameters(self):
+        device_parameters = {}
+        for field in DEVICE_FIELDS:
+            if getattr(self, field) is not None:
+                device_parameters[field] = getattr(self, field)
+        return device_parameters
+
+
+def make_device_records(count):
+    """ Device records shaped like an APIC-EM device listing
+    """
+    states = ['PENDING', 'PROVISIONED', 'ERROR', 'UNCLAIMED']
+    platforms = ['WS-C3650-48PQ', 'WS-C2960X-48FPS', 'C9300-48P']
+    records = []
+    for i in range(count):
+        records.append({
+            'id': '%08x-0000-4000-8000-%012x' % (i, i),
+            'hostName': 'switch%d' % i,
+            'serialNumber': 'FOC%08d' % i,
+            'platformId': platforms[i % len(platforms)],
+            'state': states[i % len(states)],
+            'stateDisplay': states[i % len(states)].title(),
+            'authStatus': 'Unknown',
+            'site': 'Site%d' % (i // 500),
+            'imageId': 'f439bbc9-a73f-45e9-88f0-11f86152cd08',
+            'configId': '%08x-1111-4000-8000-%012x' % (i, i),
+            'pkiEnabled': False,
+            'sudiRequired': False,
+            'lastContact': 1500000000000 + i,
+            'lastStateTransitionTime': 1500000000000 + i,
+            'imagePreference': 'FILE',
+            'configPreference': 'FILE',
+        })
+    return records
+
+
+def measure(name, records_json, load, serialize):
+    """ Loads the devices from JSON (as they would come from APIC-EM), then serializes them back to
+        device_parameters.  Prints the time of each, and the memory the loaded devices hold on to
+        (measured in a second load, since tracing memory slows everything down)
+    """
+    records = json.loads(records_json)
+    start = time.perf_counter()
+    devices = load(records)
+    load_time = time.perf_counter() - start
+    start = time.perf_counter()
+    serialize(devices)
+    serialize_time = time.perf_counter() - start
+    del records, devices
+
+    tracemalloc.start()
+    devices = load(json.loads(records_json))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('%-14s load %7.3fs  serialize %7.3fs  memory %8.1f MB' % (name, load_time, serialize_time, current / 1048576.0))
+    return devices
+
+
+def load_devices(device_class):
+    def load(records):
+        devices = []
+        for record in records:
+            device = device_class()
+            device.populate_device(record)
+            devices.append(device)
+        return devices
+    return load
+
+
+def benchmark_device_model(count):
+    print('Device model: %d devices' % count)
+    records_json = json.dumps(make_device_records(count))
+    measure('LegacyDevice', records_json, load_devices(LegacyDevice),
+            lambda devices: [device.create_device_parameters() for device in devices])
+    measure('PnpDevice', records_json, load_devices(PnpDevice),
+            lambda devices: [device.create_device_parameters() for device in devices])
+    measure('DeviceTable', records_json, DeviceTable.from_records,
+            lambda table: list(table))
+
+
+def run(mock, name, size, function):
+    """ Runs function and prints its wall time and the number of requests the mock received
+    """
+    mock.reset_counts()
+    start = time.perf_counter()
+    # The library prints a line per device added, which would drown the results
+    with redirect_stdout(io.StringIO()):
+        result = function()
+    elapsed = time.perf_counter() - start
+    print('%-36s %6d %9.3fs %9d' % (name, size, elapsed, mock.request_count()))
+    return result
+
+
+def make_device_definitions(prefix, count):
+    return [{'hostName': '%s-switch%d' % (prefix, i), 'serialNumber': 'FOC%s%08d' % (prefix, i),
+             'platformId': 'WS-C3650-48PQ'} for i in range(count)]
+
+
+def benchmark_project(mock, credentials, size):
+    proj = PnpProject(credentials)
+    proj.siteName = 'bulk-%d' % size
+    run(mock, 'create_project', 1, proj.create_project)
+    run(mock, 'add_devices', size, lambda: proj.add_devices(make_device_definitions('bulk', size)))
+    run(mock, 'get_project_by_id', size, lambda: PnpProject(credentials).get_project_by_id(proj.id))
+    device_ids = [device.id for device in proj.device_list.values()]
+    run(mock, 'get_device_by_id (every device)', size, lambda: [proj.get_device_by_id(id) for id in device_ids])
+    run(mock, 'update_devices', size,
+        lambda: proj.update_devices([{'id': id, 'imageId': 'benchmark-image'} for id in device_ids]))
+    run(mock, 'delete_devices', size, lambda: proj.delete_devices(device_ids))
+
+    if size <= MAX_SINGLE_ADDS:
+        single = PnpProject(credentials)
+        single.siteName = 'single-%d' % size
+        single.create_project()
+
+        def add_one_by_one():
+            for device_definition in make_device_definitions('single', size):
+                single.add_device_with_parameters(device_definition)
+        run(mock, 'add_device_with_parameters', size, add_one_by_one)
+
+
+def benchmark_file_lookups(mock, credentials, count):
+    path = tempfile.mkdtemp()
+    try:
+        for i in range(count):
+            with open(os.path.join(path, 'switch%d' % i), 'w') as config:
+                config.write('hostname switch%d\n' % i)
+        fh = PnpFileHandler(credentials)
+        file_ids = run(mock, 'upload_file', count,
+                       lambda: [fh.upload_file(os.path.join(path, 'switch%d' % i)) for i in range(count)])
+    finally:
+        shutil.rmtree(path)
+
+    fh = PnpFileHandler(credentials)
+    run(mock, 'get_file_id_by_name', count,
+        lambda: [fh.get_file_id_by_name('switch%d.txt' % i) for i in range(count)])
+    run(mock, 'get_file_name_by_id', count, lambda: [fh.get_file_name_by_id(id) for id in file_ids])
+    run(mock, 'get_file_id_by_name (missing)', count,
+        lambda: [fh.get_file_id_by_name('missing%d.txt' % i) for i in range(count)])
+
+
+def benchmark_fleet_listing(mock, credentials):
+    def list_fleet():
+        device_count = 0
+        for project in iter_projects(credentials):
+            project.get_project_by_id(project.id)
+            device_count += len(project.device_list)
+        return device_count
+    # Listed once to count the devices, then measured
+    device_count = list_fleet()
+    run(mock, 'iter_projects + get_project_by_id', device_count, list_fleet)
+
+
+def benchmark_api(sizes=API_SIZES, latency=MOCK_LATENCY, task_delay=MOCK_TASK_DELAY):
+    print('API against the mock APIC-EM: latency %.3fs, task delay %.3fs' % (latency, task_delay))
+    print('%-36s %6s %10s %9s' % ('', 'size', 'wall', 'requests'))
+    mock = MockApicEm(latency=latency, task_delay=task_delay).start()
+    try:
+        credentials = mock.login()
+        for size in sizes:
+            benchmark_project(mock, credentials, size)
+        benchmark_file_lookups(mock, credentials, FILE_COUNT)
+        benchmark_fleet_listing(mock, credentials)
+    finally:
+        mock.stop()
+
+
+def benchmark_overload(capacity=MOCK_CAPACITY, latency=0.02):
+    print('Overloaded mock APIC-EM: capacity %d, latency %.3fs, %d workers' % (capacity, latency, OVERLOAD_WORKERS))
+    print('%-36s %6s %10s %9s %9s %9s' % ('', 'size', 'wall', 'requests', 'rejected', 'failed'))
+    for name, controller in (('fleet_snapshot (fixed workers)', None),
+                             ('fleet_snapshot (controller)', PnpConcurrencyController())):
+        mock = MockApicEm(latency=latency, task_delay=MOCK_TASK_DELAY).start()
+        try:
+            credentials = mock.login(controller=controller, backoff_factor=0.05)
+            with redirect_stdout(io.StringIO()):
+                for i in range(OVERLOAD_PROJECTS):
+                    proj = PnpProject(credentials)
+                    proj.siteName = 'overload-%d' % i
+                    proj.create_project()
+                    proj.add_devices(make_device_definitions('overload', 500))
+            # Only the listing runs against the capacity
+            mock.capacity = capacity
+            mock.reset_counts()
+            start = time.perf_counter()
+            with redirect_stdout(io.StringIO()):
+                snapshot = fleet_snapshot(credentials, workers=OVERLOAD_WORKERS, page_size=20)
+            print('%-36s %6d %9.3fs %9d %9d %9d' % (name, len(snapshot.devices()), time.perf_counter() - start,
+                                                  mock.request_count(), mock.rejected, len(snapshot.failed)))
+        finally:
+            mock.stop()
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == 'api':
+        benchmark_api([int(size) for size in args[1:]] or API_SIZES)
+    elif args and args[0] == 'overload':
+        benchmark_overload(int(args[1]) if len(args) > 1 else MOCK_CAPACITY)
+    elif args and args[0] == 'model':
+        benchmark_device_model(int(args[1]) if len(args) > 1 else 20000)
+    elif args:
+        benchmark_device_model(int(args[0]))
+    else:
+        benchmark_device_model(20000)
+        print('')
+        benchmark_api()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,8 @@ CONFIG_PATH = '/path/to/configs/'
 IMAGE_NAME = 'cat3k_caa-universalk9.SPA.03.07.04.E.152-3.E4.bin'
 IMAGE_PATH = '/path/to/images/'
 PLATFORM = 'WS-C3650-48P'
+# Record of the configs uploaded and devices created, so an interrupted run picks up where it stopped
+JOURNAL_PATH = '/path/to/pnp_journal.jsonl'
 
 credentials = pnp_login(username='admin', password='password', server='1.1.1.1')
 
@@ -27,15 +29,17 @@ image_id = fh.get_file_id_by_name(IMAGE_NAME, 'image')
 if image_id is None:
     image_id = fh.upload_file(IMAGE_PATH + IMAGE_NAME, 'image')
 
-#Loop through the configs in the config path and upload the config and create a device for each
+#Upload each config in the config path and create a device for it, uploads and device creation run in parallel
 #Name the files the device_name (don't add the .txt extension) and it create the device based on the name in the 
-for file in os.listdir(CONFIG_PATH):
-    config_id = fh.get_file_id_by_name(file)
-    if config_id is None:
-        config_id = fh.upload_file(CONFIG_PATH+'/'+file+'.txt')
-    if config_id is not None:
+def devices():
+    for file in sorted(os.listdir(CONFIG_PATH)):
         #replace any dots in the file name with dashes because device names cannot include dots
         device_name = file.replace('.', '-')
-        device_definition = {'imageId': image_id, 'platformId': PLATFORM, 'configId': config_id, 'hostName': device_name}
-        proj.add_device_with_parameters(device_definition)
-
+        device_definition = {'imageId': image_id, 'platformId': PLATFORM, 'hostName': device_name}
+        yield (os.path.join(CONFIG_PATH, file), device_definition)
+
+pipeline = ProvisioningPipeline(proj, fh, journal_path=JOURNAL_PATH)
+pipeline.run(devices())
+for stage in ProvisioningPipeline.STAGES:
+    print('%s: %d done, %d failed, %d skipped, %.1f per second' % (stage, pipeline.stats[stage]['processed'],
+          pipeline.stats[stage]['failed'], pipeline.stats[stage]['skipped'], pipeline.stats[stage]['per_second']))
@@ -0,0 +1,384 @@
+#!/usr/bin/python
+""" A local mock of the APIC-EM endpoints used by PnpProject: ticket, file namespace/upload/delete,
+    pnp-project and project devices, and task polling.  It keeps everything in memory and serves
+    plain http on localhost, so the library can be benchmarked and scripts tried without a controller.
+
+    >>> mock = MockApicEm(latency=0.005, task_delay=0.1).start()
+    >>> credentials = mock.login()
+    >>> proj = PnpProject(credentials)
+    ...
+    >>> mock.counts
+    Counter({'GET /api/v1/task/{id}': 12, 'POST /api/v1/pnp-project/{id}/device': 3, ...})
+    >>> mock.stop()
+
+    Or run it on its own: python mock_apicem.py [port]
+"""
+import collections
+import hashlib
+import json
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from PnpProject import pnp_login, endpoint_template
+
+# APIC-EM returns at most this many records per page
+MOCK_PAGE_LIMIT = 500
+
+
+class MockApicEm:
+    """ MockApicEm serves the mock APIC-EM on host:port (port 0 picks a free port).
+
+        latency is added to every response (seconds), tasks complete task_delay seconds after they
+        are created and listings return at most page_limit records per request.  Tickets are only
+        handed out for username/password.  counts is a Counter of the requests received, by method
+        and endpoint template (ex: 'POST /api/v1/pnp-project/{id}/device').  With capacity, requests
+        that arrive while capacity requests are already being handled get a 503, like an overloaded
+        controller, and rejected counts them.  With rule_ids=False device create tasks don't report the
+        ids of the devices they created, like some APIC-EM releases.
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0, task_delay=0, page_limit=MOCK_PAGE_LIMIT,
+                 username='admin', password='password', capacity=None, rule_ids=True):
+        self.latency = latency
+        self.rule_ids = rule_ids
+        self.capacity = capacity
+        self.active = 0
+        self.rejected = 0
+        self.task_delay = task_delay
+        self.page_limit = page_limit
+        self.username = username
+        self.password = password
+        self.tickets = set()
+        self.files = {'config': collections.OrderedDict(), 'image': collections.OrderedDict()}
+        self.projects = collections.OrderedDict()
+        self.devices = {}
+        self.tasks = {}
+        self.counts = collections.Counter()
+        self.lock = threading.RLock()
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def server(self):
+        """ host:port of the mock, to pass to pnp_login with scheme='http'
+        """
+        return '%s:%d' % self.httpd.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='MockApicEm')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def login(self, **client_options):
+        """ pnp_login to the mock, without the ticket cache
+        """
+        client_options.setdefault('ticket_cache', None)
+        return pnp_login(self.username, self.password, self.server, scheme='http', **client_options)
+
+    def reset_counts(self):
+        with self.lock:
+            self.counts.clear()
+
+    def request_count(self):
+        return sum(self.counts.values())
+
+    def add_task(self, progress=None, failure_reason=None):
+        """ Returns the id of a new task, which completes task_delay seconds from now with progress
+            (a python literal, like APIC-EM) or fails with failure_reason
+        """
+        task_id = str(uuid.uuid4())
+        with self.lock:
+            self.tasks[task_id] = {'id': task_id, 'startTime': time.time(), 'progress': progress,
+                                   'failureReason': failure_reason}
+        return task_id
+
+    def task_status(self, task_id):
+        task = self.tasks.get(task_id)
+        if task is None:
+            return None
+        status = {'id': task_id, 'startTime': int(task['startTime'] * 1000), 'isError': False,
+                  'progress': 'In Progress'}
+        if time.time() - task['startTime'] >= self.task_delay:
+            status['endTime'] = int((task['startTime'] + self.task_delay) * 1000)
+            if task['failureReason'] is not None:
+                status['isError'] = True
+                status['failureReason'] = task['failureReason']
+            else:
+                status['progress'] = task['progress']
+        return status
+
+
+def _error(code, message, detail=''):
+    return {'response': {'errorCode': code, 'message': message, 'detail': detail}}
+
+
+def _read_upload(request):
+    """ Returns (file name, content) of the 'file' part of a multipart upload
+    """
+    request.body_read = True
+    body = request.rfile.read(int(request.headers.get('Content-Length') or 0))
+    boundary = re.search(r'boundary=("?)([^";]+)\1', request.headers.get('Content-Type', ''))
+    if boundary is None:
+        return None, None
+    for part in body.split(b'--' + boundary.group(2).encode()):
+        headers, _, content = part.partition(b'\r\n\r\n')
+        match = re.search(rb'name="file"; filename="([^"]*)"', headers)
+        if match:
+            return match.group(1).decode(), content[:-2]
+    return None, None
+
+
+def _make_handler(mock):
+    routes = []
+
+    def route(method, pattern):
+        def register(function):
+            routes.append((method, re.compile('^' + pattern + '$'), function))
+            return function
+        return register
+
+    def page(records, query):
+        offset = int(query.get('offset', ['1'])[0])
+        limit = min(int(query.get('limit', [str(mock.page_limit)])[0]), mock.page_limit)
+        return records[offset - 1:offset - 1 + limit]
+
+    @route('POST', '/api/v1/ticket')
+    def ticket(request, query):
+        credentials = request.json()
+        if credentials.get('username') != mock.username or credentials.get('password') != mock.password:
+            return 401, _error('INVALID_CREDENTIALS', 'Invalid credentials')
+        ticket = 'ST-' + uuid.uuid4().hex
+        mock.tickets.add(ticket)
+        return 200, {'response': {'serviceTicket': ticket, 'idleTimeout': 1800, 'sessionTimeout': 21600}}
+
+    @route('GET', '/api/v1/file/namespace/(config|image)')
+    def get_namespace(request, query, type):
+        return 200, {'response': list(mock.files[type].values())}
+
+    @route('POST', '/api/v1/file/(config|image)')
+    def upload_file(request, query, type):
+        file_name, data = _read_upload(request)
+        if file_name is None:
+            return 400, _error('BAD_REQUEST', 'No file in the request')
+        with mock.lock:
+            for file in mock.files[type].values():
+                if file['name'] == file_name:
+                    return 409, _error('FILE_ALREADY_EXISTS', 'File already exists', file_name)
+            file = {'id': str(uuid.uuid4()), 'name': file_name, 'nameSpace': type, 'fileSize': str(len(data)),
+                    'md5Checksum': hashlib.md5(data).hexdigest(), 'sha1Checksum': hashlib.sha1(data).hexdigest(),
+                    'fileFormat': 'text/plain' if type == 'config' else 'application/octet-stream'}
+            mock.files[type][file['id']] = file
+        return 200, {'response': file}
+
+    @route('DELETE', '/api/v1/pnp-file/(config|image)/([^/]+)')
+    def delete_file(request, query, type, file_id):
+        with mock.lock:
+            if mock.files[type].pop(file_id, None) is None:
+                return 200, {'response': {'taskId': mock.add_task(failure_reason='File not found: ' + file_id)}}
+        return 200, {'response': {'taskId': mock.add_task("{'message': 'Success'}")}}
+
+    @route('GET', '/api/v1/task/([^/]+)')
+    def get_task(request, query, task_id):
+        status = mock.task_status(task_id)
+        if status is None:
+            return 404, _error('NOT_FOUND', 'Task not found', task_id)
+        return 200, {'response': status}
+
+    @route('GET', '/api/v1/pnp-project')
+    def get_projects(request, query):
+        projects = list(mock.projects.values())
+        if 'siteName' in query:
+            projects = [project for project in projects if project['siteName'] == query['siteName'][0]]
+        return 200, {'response': page(projects, query)}
+
+    @route('POST', '/api/v1/pnp-project')
+    def create_projects(request, query):
+        new_projects = request.json()
+        with mock.lock:
+            for project in new_projects:
+                if any(p['siteName'] == project.get('siteName') for p in mock.projects.values()):
+                    return 200, {'response': {'taskId': mock.add_task(
+                        failure_reason='Site name already exists: %s' % project.get('siteName'))}}
+            for project in new_projects:
+                project = dict(project)
+                project.update({'id': str(uuid.uuid4()), 'state': 'PRE_PROVISIONED', 'deviceCount': 0,
+                                'pendingDeviceCount': 0, 'provisionedOn': str(int(time.time() * 1000))})
+                mock.projects[project['id']] = project
+                mock.devices[project['id']] = collections.OrderedDict()
+        return 200, {'response': {'taskId': mock.add_task(repr({'siteId': project['id']}))}}
+
+    @route('PUT', '/api/v1/pnp-project')
+    def update_projects(request, query):
+        with mock.lock:
+            for project in request.json():
+                if project.get('id') not in mock.projects:
+                    return 200, {'response': {'taskId': mock.add_task(failure_reason='Project not found')}}
+                mock.projects[project['id']].update(project)
+                project_updated(project['id'])
+        return 200, {'response': {'taskId': mock.add_task("{'message': 'Success'}")}}
+
+    @route('GET', '/api/v1/pnp-project/([^/]+)')
+    def get_project(request, query, project_id):
+        if project_id not in mock.projects:
+            return 404, _error('NOT_FOUND', 'Project not found', project_id)
+        return 200, {'response': mock.projects[project_id]}
+
+    @route('DELETE', '/api/v1/pnp-project/([^/]+)')
+    def delete_project(request, query, project_id):
+        with mock.lock:
+            if mock.projects.pop(project_id, None) is None:
+                return 200, {'response': {'taskId': mock.add_task(failure_reason='Project not found')}}
+            del mock.devices[project_id]
+        return 200, {'response': {'taskId': mock.add_task("{'message': 'Success'}")}}
+
+    def project_updated(project_id):
+        devices = mock.devices[project_id]
+        project = mock.projects[project_id]
+        project['deviceCount'] = len(devices)
+        project['pendingDeviceCount'] = sum(1 for device in devices.values() if device['state'] == 'PENDING')
+        project['deviceLastUpdate'] = int(time.time() * 1000)
+
+    @route('GET', '/api/v1/pnp-project/([^/]+)/device')
+    def get_devices(request, query, project_id):
+        if project_id not in mock.devices:
+            return 404, _error('NOT_FOUND', 'Project not found', project_id)
+        return 200, {'response': page(list(mock.devices[project_id].values()), query)}
+
+    @route('POST', '/api/v1/pnp-project/([^/]+)/device')
+    def add_devices(request, query, project_id):
+        new_devices = request.json()
+        with mock.lock:
+            devices = mock.devices.get(project_id)
+            if devices is None:
+                return 200, {'response': {'taskId': mock.add_task(failure_reason='Project not found')}}
+            host_names = set(device.get('hostName') for device in devices.values())
+            for device in new_devices:
+                if device.get('hostName') is not None and device['hostName'] in host_names:
+                    return 200, {'response': {'taskId': mock.add_task(
+                        failure_reason='Device with hostName %s already exists' % device['hostName'])}}
+            rule_ids = []
+            now = int(time.time() * 1000)
+            for device in new_devices:
+                device = dict(device)
+                device.update({'id': str(uuid.uuid4()), 'state': 'PENDING', 'stateDisplay': 'Pending',
+                               'authStatus': 'Unknown', 'lastStateTransitionTime': now})
+                devices[device['id']] = device
+                rule_ids.append(device['id'])
+            project_updated(project_id)
+        if not mock.rule_ids:
+            progress = {'message': 'Success'}
+        elif len(rule_ids) == 1:
+            progress = {'ruleId': rule_ids[0]}
+        else:
+            progress = {'ruleIds': rule_ids}
+        return 200, {'response': {'taskId': mock.add_task(repr(progress))}}
+
+    @route('PUT', '/api/v1/pnp-project/([^/]+)/device')
+    def update_devices(request, query, project_id):
+        updated_devices = request.json()
+        with mock.lock:
+            devices = mock.devices.get(project_id)
+            for device in updated_devices:
+                if devices is None or device.get('id') not in devices:
+                    return 200, {'response': {'taskId': mock.add_task(failure_reason='Device not found')}}
+            for device in updated_devices:
+                devices[device['id']].update(device)
+                devices[device['id']]['lastStateTransitionTime'] = int(time.time() * 1000)
+            project_updated(project_id)
+        return 200, {'response': {'taskId': mock.add_task("{'message': 'Success'}")}}
+
+    @route('DELETE', '/api/v1/pnp-project/([^/]+)/device/([^/]+)')
+    def delete_device(request, query, project_id, device_id):
+        with mock.lock:
+            devices = mock.devices.get(project_id)
+            if devices is None or devices.pop(device_id, None) is None:
+                return 200, {'response': {'taskId': mock.add_task(failure_reason='Device not found')}}
+            project_updated(project_id)
+        return 200, {'response': {'taskId': mock.add_task("{'message': 'Success'}")}}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Responses are small, don't let Nagle hold them back
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def json(self):
+            self.body_read = True
+            length = int(self.headers.get('Content-Length') or 0)
+            return json.loads(self.rfile.read(length) or b'null')
+
+        def handle_method(self, method):
+            url = urlparse(self.path)
+            with mock.lock:
+                mock.counts[method + ' ' + endpoint_template(url.path)] += 1
+                overloaded = mock.capacity is not None and mock.active >= mock.capacity
+                if overloaded:
+                    mock.rejected += 1
+                else:
+                    mock.active += 1
+            self.body_read = False
+            if overloaded:
+                status, body = 503, _error('SERVICE_UNAVAILABLE', 'Too many requests in progress')
+            else:
+                try:
+                    status, body = self.route(method, url)
+                    # The request is in progress until its response is sent
+                    if mock.latency:
+                        time.sleep(mock.latency)
+                finally:
+                    with mock.lock:
+                        mock.active -= 1
+            if not self.body_read:
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def route(self, method, url):
+            for route_method, pattern, function in routes:
+                match = pattern.match(url.path)
+                if route_method == method and match:
+                    if url.path != '/api/v1/ticket' and self.headers.get('X-Auth-Token') not in mock.tickets:
+                        return 401, _error('UNAUTHORIZED', 'Invalid or expired ticket')
+                    return function(self, parse_qs(url.query), *match.groups())
+            return 404, _error('NOT_FOUND', 'No such endpoint', method + ' ' + url.path)
+
+        def do_GET(self):
+            self.handle_method('GET')
+
+        def do_POST(self):
+            self.handle_method('POST')
+
+        def do_PUT(self):
+            self.handle_method('PUT')
+
+        def do_DELETE(self):
+            self.handle_method('DELETE')
+
+    return Handler
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    mock = MockApicEm(port=port)
+    print('Mock APIC-EM on http://%s (username %s, password %s)' % (mock.server, mock.username, mock.password))
+    mock.httpd.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+""" REST call counts of adding devices, against the mock APIC-EM (python -m pytest test_PnpProject.py)
+"""
+import io
+import unittest
+from contextlib import redirect_stdout
+
+from PnpProject import PnpProject, DEFAULT_PAGE_SIZE
+from mock_apicem import MockApicEm
+
+DEVICES_URL = 'GET /api/v1/pnp-project/{id}/device'
+
+
+class AddDeviceTest(unittest.TestCase):
+    rule_ids = True
+
+    def setUp(self):
+        self.mock = MockApicEm(rule_ids=self.rule_ids).start()
+        self.credentials = self.mock.login()
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def make_project(self, device_count):
+        proj = PnpProject(self.credentials)
+        proj.siteName = 'site-%d' % device_count
+        proj.create_project()
+        if device_count:
+            with redirect_stdout(io.StringIO()):
+                proj.add_devices([{'hostName': 'switch%d' % i} for i in range(device_count)])
+        return proj
+
+    def add_device(self, proj, host_name):
+        self.mock.reset_counts()
+        with redirect_stdout(io.StringIO()):
+            device = proj.add_device_with_parameters({'hostName': host_name, 'platformId': 'WS-C3650-48PQ'})
+        return device, dict(self.mock.counts)
+
+
+class TestAddDeviceCalls(AddDeviceTest):
+    def test_calls_do_not_grow_with_project_size(self):
+        device, small = self.add_device(self.make_project(0), 'new-switch')
+        self.assertIsNotNone(device.id)
+        device, large = self.add_device(self.make_project(DEFAULT_PAGE_SIZE * 2 + 100), 'new-switch')
+        self.assertIsNotNone(device.id)
+        self.assertEqual(small, large)
+        self.assertEqual(small, {'POST /api/v1/pnp-project/{id}/device': 1, 'GET /api/v1/task/{id}': 1,
+                                 'GET /api/v1/pnp-project/{id}': 1})
+
+    def test_device_is_built_from_the_parameters_sent(self):
+        proj = self.make_project(3)
+        device, counts = self.add_device(proj, 'new-switch')
+        self.assertNotIn(DEVICES_URL, counts)
+        self.assertEqual(device.platformId, 'WS-C3650-48PQ')
+        self.assertIs(proj.get_device_by_id(device.id), device)
+        self.assertEqual(device.id, [id for id, record in self.mock.devices[proj.id].items()
+                                     if record['hostName'] == 'new-switch'][0])
+
+
+class TestAddDeviceFallback(AddDeviceTest):
+    """ The create task doesn't report the device id, it is looked up in the project listing
+    """
+    rule_ids = False
+
+    def test_listing_is_read_until_the_device_is_found(self):
+        proj = self.make_project(DEFAULT_PAGE_SIZE * 2 + 100)
+        device, counts = self.add_device(proj, 'new-switch')
+        # The new device is on the third page
+        self.assertEqual(counts[DEVICES_URL], 3)
+        self.assertFalse(device.error)
+        self.assertEqual(device.id, [id for id, record in self.mock.devices[proj.id].items()
+                                     if record['hostName'] == 'new-switch'][0])
+        self.assertEqual(device.state, 'PENDING')
+
+    def test_lookup_stops_at_the_page_of_the_device(self):
+        proj = self.make_project(DEFAULT_PAGE_SIZE * 2 + 100)
+        self.mock.reset_counts()
+        deviceDetail = proj.find_device_detail({'hostName': 'switch1'})
+        self.assertEqual(deviceDetail['hostName'], 'switch1')
+        self.assertEqual(self.mock.counts[DEVICES_URL], 1)
+
+    def test_device_missing_from_listing_fails(self):
+        proj = self.make_project(0)
+        self.assertIsNone(proj.find_device_detail({'hostName': 'missing'}))
+        self.assertIsNone(proj.find_device_detail({}))
+
+
+if __name__ == '__main__':
+    unittest.main()